@@ -0,0 +1,156 @@
+import asyncio
+import concurrent.futures
+import itertools
+from serialize.database import Database
+from typing import *
+
+T = TypeVar("T")
+
+
+def set_exception(future: asyncio.Future, exception: Exception):
+    # The caller may have been cancelled
+    if not future.done():
+        future.set_exception(exception)
+
+
+class AsyncDatabase(Generic[T]):
+    """asyncio interface to a Database
+
+    All SQLite I/O and JSON encoding/decoding runs on a dedicated worker thread, so the event
+    loop is never blocked. Inserts submitted while a commit is in progress are batched into the
+    next transaction (group commit). With `pool_size` set, reads run on a second thread with
+    their own connection, so they don't wait for writes.
+    """
+    datatype: Callable[..., T]
+
+    def __init__(self, datatype: Callable[..., T], filename: str='data.db', **kwargs):
+        """
+        Args:
+            datatype: Type of the stored objects
+            filename (str, optional): SQLite database file. Defaults to 'data.db'.
+            **kwargs: Passed on to Database
+        """
+        self.datatype = datatype
+        self.write_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='AsyncDatabase-writer')
+        if kwargs.get('pool_size', 0) > 0:
+            self.read_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='AsyncDatabase-reader')
+        else:
+            self.read_executor = self.write_executor
+
+        # Created on the writer thread, which owns the connection when it isn't pooled
+        self.database_future = self.write_executor.submit(Database, datatype, filename, **kwargs)
+
+        # Inserts waiting for the next group commit
+        self.pending: List[Tuple[List[T], asyncio.Future]] = []
+        self.committing = False
+        self.commit_task: Optional[asyncio.Task] = None
+
+
+    async def run_write(self, function: Callable[[Database[T]], any]) -> any:
+        return await asyncio.get_running_loop().run_in_executor(self.write_executor, lambda: function(self.database_future.result()))
+
+
+    async def run_read(self, function: Callable[[Database[T]], any]) -> any:
+        return await asyncio.get_running_loop().run_in_executor(self.read_executor, lambda: function(self.database_future.result()))
+
+
+    async def insert(self, new_item: T) -> int:
+        return (await self.insert_many([new_item]))[0]
+
+
+    async def insert_many(self, new_items: Iterable[T]) -> List[int]:
+        """Inserts `new_items`, returning their ids once they're committed
+
+        The items may be committed in the same transaction as other concurrently submitted inserts.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((list(new_items), future))
+
+        if not self.committing:
+            self.committing = True
+            self.commit_task = asyncio.get_running_loop().create_task(self.commit_pending())
+
+        return await future
+
+
+    async def commit_pending(self):
+        try:
+            while len(self.pending) > 0:
+                group = self.pending
+                self.pending = []
+
+                try:
+                    await self.commit_group(group)
+                except Exception as e:
+                    if len(group) == 1:
+                        set_exception(group[0][1], e)
+                        continue
+
+                    # Commit each insert on its own, so only the failing ones fail
+                    for request in group:
+                        try:
+                            await self.commit_group([request])
+                        except Exception as e:
+                            set_exception(request[1], e)
+        finally:
+            self.committing = False
+
+
+    async def commit_group(self, group: List[Tuple[List[T], asyncio.Future]]):
+        items = [item for request_items, future in group for item in request_items]
+        ids = await self.run_write(lambda database: database.insert_many(items))
+
+        start = 0
+        for request_items, future in group:
+            if not future.done():
+                future.set_result(ids[start:start + len(request_items)])
+            start += len(request_items)
+
+
+    async def _iterate(self, make_iterator: Callable[[Database[T]], Iterator], chunk_size: int) -> AsyncIterator:
+        iterator = await self.run_read(make_iterator)
+        try:
+            while True:
+                chunk = await self.run_read(lambda database: list(itertools.islice(iterator, chunk_size)))
+                if len(chunk) == 0:
+                    return
+                for item in chunk:
+                    yield item
+        finally:
+            if hasattr(iterator, 'close'):
+                await self.run_read(lambda database: iterator.close())
+
+
+    def select(self, *args, chunk_size: int=1000, **kwargs) -> AsyncIterator:
+        """Async iterator over Database.select(*args, **kwargs), decoded `chunk_size` objects at a time on the worker thread"""
+        return self._iterate(lambda database: database.select(*args, **kwargs), chunk_size)
+
+
+    def iterate(self, *args, chunk_size: int=1000, **kwargs) -> AsyncIterator:
+        return self._iterate(lambda database: database.iterate(*args, **kwargs), chunk_size)
+
+
+    async def fetchall(self) -> List[T]:
+        return await self.run_read(lambda database: database.fetchall())
+
+
+    async def get(self, id: int) -> Optional[T]:
+        return await self.run_read(lambda database: database.get(id))
+
+
+    async def delete(self, *args, **kwargs):
+        await self.run_write(lambda database: database.delete(*args, **kwargs))
+
+
+    async def create_index(self, key_path: str):
+        await self.run_write(lambda database: database.create_index(key_path))
+
+
+    async def close(self):
+        # Inserts submitted while waiting start a new commit task
+        while self.commit_task is not None and not self.commit_task.done():
+            await asyncio.shield(self.commit_task)
+
+        await self.run_write(lambda database: database.close())
+        self.write_executor.shutdown()
+        self.read_executor.shutdown()
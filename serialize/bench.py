@@ -0,0 +1,342 @@
+#!/usr/env python3
+"""Benchmarks of serialize.json, serialize.database and serialize.sqlite
+
+    python -m serialize.bench [--size N] [--save results.json] [--baseline results.json]
+
+Each benchmark times a series of operations on a synthetic workload, and reports the
+throughput in items per second, the latency percentiles of single operations, and the peak
+memory allocated by Python while running them. Results saved with `--save` can be compared
+against later runs with `--baseline`, which exits with status 1 if anything regressed.
+"""
+
+from dataclasses import *
+from typing import *
+from serialize import json
+from serialize import query
+from serialize import sqlite
+from serialize.database import Database
+import argparse
+import gc
+import itertools
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+# Workload types, at module level so they're importable by name
+
+@dataclass
+class Record:
+    name: str
+    email: str
+    age: int
+    score: float
+    town: str
+
+
+@dataclass
+class Address:
+    number: int
+    street: str
+    town: str
+    state: str
+
+
+@dataclass
+class Person:
+    name: str
+    age: int
+    address: Address
+    hobbies: List[str] = field(default_factory=list)
+
+
+@dataclass
+class Item:
+    baz: int
+    bar: float
+
+
+@dataclass
+class Nested:
+    a: int = 0
+    b: float = 0.0
+    c: Dict[str, List[Item]] = field(default_factory=dict)
+    d: List[Dict[str, Item]] = field(default_factory=list)
+
+
+towns = ['Grantham', 'Concord', 'Hanover', 'Keene', 'Nashua', 'Dover', 'Lebanon', 'Exeter']
+hobby_names = ['programming', 'hiking', 'chess', 'cooking', 'running', 'reading', 'climbing', 'painting', 'sailing', 'music']
+
+
+@dataclass
+class Workload:
+    name: str
+    Type: any
+    # Builds object i, with `width` elements in each of its lists and dicts
+    make: Callable[[random.Random, int, int], any]
+    index_key_paths: List[str]
+    # Predicate for the i-th select
+    where: Callable[[int], query.Predicate]
+
+
+def make_record(rng: random.Random, i: int, width: int) -> Record:
+    return Record(f'name{i}', f'user{i}@example.com', rng.randrange(18, 90), rng.random() * 100, rng.choice(towns))
+
+
+def make_person(rng: random.Random, i: int, width: int) -> Person:
+    address = Address(rng.randrange(1, 1000), f'{rng.choice(towns)} Road', rng.choice(towns), 'NH')
+    return Person(f'name{i}', rng.randrange(18, 90), address, rng.sample(hobby_names, min(width, len(hobby_names))))
+
+
+def make_nested(rng: random.Random, i: int, width: int) -> Nested:
+    return Nested(
+        a=i,
+        b=rng.random(),
+        c={f'key{k}': [Item(rng.randrange(1000), rng.random()) for j in range(width)] for k in range(width)},
+        d=[{f'key{k}': Item(rng.randrange(1000), rng.random()) for k in range(width)} for j in range(width)])
+
+
+workloads = {
+    'flat': Workload('flat', Record, make_record, ['age', 'town'], lambda i: query.eq('age', 18 + i % 72)),
+    'person': Workload('person', Person, make_person, ['hobbies', 'address.town'], lambda i: query.eq('hobbies', hobby_names[i % len(hobby_names)]) & query.eq('address.town', towns[i % len(towns)])),
+    'nested': Workload('nested', Nested, make_nested, ['a'], lambda i: query.between('a', i * 10, i * 10 + 99)),
+}
+
+
+@dataclass
+class Benchmark:
+    name: str
+    # Creates the state the operations run on
+    setup: Callable[[], any]
+    # Runs operation i, returning the number of items it processed
+    operation: Callable[[any, int], int]
+    operations: int
+    # Runs untimed after each operation, e.g. to undo it
+    cleanup: Optional[Callable[[any], None]] = None
+
+
+@dataclass
+class BenchResult:
+    name: str
+    operations: int = 0
+    items: int = 0
+    seconds: float = 0.0
+    items_per_second: float = 0.0
+    p50_ms: float = 0.0
+    p95_ms: float = 0.0
+    p99_ms: float = 0.0
+    # Bytes, 0 when not measured
+    peak_memory: int = 0
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if len(sorted_values) == 0:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def run_operations(benchmark: Benchmark, state: any) -> Tuple[int, List[float]]:
+    """Runs all of the benchmark's operations on `state`, fresh from its setup, returning the items processed and each operation's duration"""
+    items = 0
+    durations: List[float] = []
+    for i in range(benchmark.operations):
+        start = time.perf_counter()
+        items += benchmark.operation(state, i)
+        durations.append(time.perf_counter() - start)
+        if benchmark.cleanup is not None:
+            benchmark.cleanup(state)
+    return items, durations
+
+
+def run_benchmark(benchmark: Benchmark, repeat: int=3, memory: bool=True) -> BenchResult:
+    """Times the benchmark's operations `repeat` times, keeping the fastest run, then measures peak memory in a separate run"""
+    best: Optional[Tuple[int, List[float]]] = None
+    for i in range(repeat):
+        state = benchmark.setup()
+        gc.collect()
+        items, durations = run_operations(benchmark, state)
+        if best is None or sum(durations) < sum(best[1]):
+            best = (items, durations)
+
+    items, durations = best
+    seconds = sum(durations)
+    durations = sorted(durations)
+    result = BenchResult(
+        name=benchmark.name,
+        operations=len(durations),
+        items=items,
+        seconds=seconds,
+        items_per_second=items / seconds if seconds > 0 else 0.0,
+        p50_ms=percentile(durations, 0.5) * 1000,
+        p95_ms=percentile(durations, 0.95) * 1000,
+        p99_ms=percentile(durations, 0.99) * 1000)
+
+    # tracemalloc slows everything down, so it isn't running while timing. It starts after the setup,
+    # so only the memory allocated by the operations is measured.
+    if memory:
+        state = benchmark.setup()
+        gc.collect()
+        tracemalloc.start()
+        try:
+            run_operations(benchmark, state)
+            result.peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return result
+
+
+def make_benchmarks(workload: Workload, size: int, width: int, directory: str) -> List[Benchmark]:
+    rng = random.Random(0)
+    objs = [workload.make(rng, i, width) for i in range(size)]
+    strings = [json.dumps(obj) for obj in objs]
+    batch_size = 1000
+    batch_count = (size + batch_size - 1) // batch_size
+    # Single-row inserts commit each row, so are run on at most this many objects
+    single_count = min(size, 1000)
+    database_files = itertools.count()
+
+    def new_database(fill: bool=False, indexed: bool=False) -> Database:
+        filename = os.path.join(directory, f'{workload.name}-{next(database_files)}.db')
+        db = Database(workload.Type, filename)
+        if indexed:
+            for key_path in workload.index_key_paths:
+                db.create_index(key_path)
+        if fill:
+            db.insert_many(objs)
+        return db
+
+    def drop_indexes(db: Database):
+        for table_name, key_path, expression in db.get_indexes():
+            db.conn.execute(f'drop index if exists {table_name}_index')
+            db.conn.execute(f'drop table if exists {table_name}')
+        db.conn.execute('delete from indexes')
+        db.conn.commit()
+
+    def create_indexes(db: Database, i: int) -> int:
+        for key_path in workload.index_key_paths:
+            db.create_index(key_path)
+        return size
+
+    def new_sqlite_database() -> sqlite3.Cursor:
+        filename = os.path.join(directory, f'{workload.name}-{next(database_files)}.sqlite')
+        cursor = sqlite3.connect(filename).cursor()
+        sqlite.create_type_table(cursor, 'objects', workload.Type)
+        return cursor
+
+    def filled_sqlite_database() -> sqlite3.Cursor:
+        cursor = new_sqlite_database()
+        sqlite.insert_many(cursor, 'objects', workload.Type, objs)
+        cursor.connection.commit()
+        return cursor
+
+    def dumps(state, i: int) -> int:
+        json.dumps(objs[i])
+        return 1
+
+    def loads(state, i: int) -> int:
+        json.loads(strings[i], workload.Type)
+        return 1
+
+    def database_insert(db: Database, i: int) -> int:
+        db.insert(objs[i])
+        return 1
+
+    def sqlite_insert(cursor: sqlite3.Cursor, i: int) -> int:
+        sqlite.insert(cursor, 'objects', workload.Type, objs[i])
+        return 1
+
+    return [
+        Benchmark('json.dumps', lambda: None, dumps, size),
+        Benchmark('json.loads', lambda: None, loads, size),
+        Benchmark('database.insert', new_database, database_insert, single_count),
+        Benchmark('database.insert_many', new_database, lambda db, i: len(db.insert_many(objs[i * batch_size:(i + 1) * batch_size])), batch_count),
+        Benchmark('database.create_index', lambda: new_database(fill=True), create_indexes, 3, cleanup=drop_indexes),
+        Benchmark('database.select', lambda: new_database(fill=True, indexed=True), lambda db, i: len(list(db.select(workload.where(i)))), 100),
+        Benchmark('database.fetchall', lambda: new_database(fill=True), lambda db, i: len(db.fetchall()), 3),
+        Benchmark('sqlite.insert', new_sqlite_database, sqlite_insert, single_count),
+        Benchmark('sqlite.insert_many', new_sqlite_database, lambda cursor, i: len(sqlite.insert_many(cursor, 'objects', workload.Type, objs[i * batch_size:(i + 1) * batch_size])), batch_count),
+        Benchmark('sqlite.get_objects', filled_sqlite_database, lambda cursor, i: sum(1 for obj in sqlite.get_objects(cursor, 'objects', workload.Type)), 3),
+    ]
+
+
+def compare(results: List[BenchResult], baseline: List[BenchResult], threshold: float) -> List[str]:
+    """Prints each result's change from the baseline, returning the names of the benchmarks whose throughput dropped by more than `threshold`"""
+    baseline_results = {result.name: result for result in baseline}
+    regressions: List[str] = []
+
+    print()
+    print(f'{"benchmark":40} {"items/s":>12} {"baseline":>12} {"change":>8} {"p95 ms":>10} {"baseline":>10}')
+    for result in results:
+        base = baseline_results.get(result.name)
+        if base is None or base.items_per_second == 0:
+            print(f'{result.name:40} {result.items_per_second:12.0f} {"-":>12}')
+            continue
+
+        change = result.items_per_second / base.items_per_second - 1
+        flag = ''
+        if change < -threshold:
+            regressions.append(result.name)
+            flag = '  REGRESSION'
+        print(f'{result.name:40} {result.items_per_second:12.0f} {base.items_per_second:12.0f} {change:+8.1%} {result.p95_ms:10.3f} {base.p95_ms:10.3f}{flag}')
+
+    return regressions
+
+
+def print_result(result: BenchResult):
+    peak_memory = f'{result.peak_memory / 2**20:.1f}' if result.peak_memory > 0 else '-'
+    print(f'{result.name:40} {result.items_per_second:12.0f} {result.p50_ms:10.3f} {result.p95_ms:10.3f} {result.p99_ms:10.3f} {peak_memory:>10}', flush=True)
+
+
+def main(args: Optional[List[str]]=None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m serialize.bench', description='Benchmarks serialize.json, serialize.database and serialize.sqlite')
+    parser.add_argument('--size', type=int, default=10000, help='number of objects in each workload (default 10000)')
+    parser.add_argument('--width', type=int, default=3, help='number of elements in each list and dict of the workload objects (default 3)')
+    parser.add_argument('--repeat', type=int, default=3, help='times to run each benchmark, keeping the fastest run (default 3)')
+    parser.add_argument('--workload', action='append', choices=list(workloads.keys()), help='workload to run, may be repeated (default all)')
+    parser.add_argument('--filter', help='only run benchmarks whose name contains this')
+    parser.add_argument('--no-memory', action='store_true', help="don't measure peak memory")
+    parser.add_argument('--save', help='save the results to this JSON file')
+    parser.add_argument('--baseline', help='compare the results with those saved in this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.1, help='throughput drop counted as a regression (default 0.1)')
+    options = parser.parse_args(args)
+
+    results: List[BenchResult] = []
+    print(f'{"benchmark":40} {"items/s":>12} {"p50 ms":>10} {"p95 ms":>10} {"p99 ms":>10} {"peak MiB":>10}')
+
+    with tempfile.TemporaryDirectory() as directory:
+        for workload_name in options.workload or workloads.keys():
+            workload = workloads[workload_name]
+            for benchmark in make_benchmarks(workload, options.size, options.width, directory):
+                benchmark.name = f'{workload.name}/{benchmark.name}'
+                if options.filter is not None and options.filter not in benchmark.name:
+                    continue
+
+                result = run_benchmark(benchmark, options.repeat, not options.no_memory)
+                print_result(result)
+                results.append(result)
+
+                # Close the benchmark's database connections before the directory is removed
+                gc.collect()
+
+    if options.save is not None:
+        with open(options.save, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+    if options.baseline is not None:
+        with open(options.baseline) as fp:
+            baseline = json.load(fp, List[BenchResult])
+        regressions = compare(results, baseline, options.threshold)
+        if len(regressions) > 0:
+            print(f'\n{len(regressions)} regressions: {", ".join(regressions)}')
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,162 @@
+#!/usr/env python3
+
+from dataclasses import *
+from typing import *
+from serialize import json
+import marshal
+import sys
+import threading
+import zlib
+
+T = TypeVar("T")
+
+normal_types = json.normal_types
+
+
+@dataclass(frozen=True)
+class BinaryCodec(Generic[T]):
+    """Compact binary encoding of a type, compiled by `codec_for`
+
+    Python objects are stored positionally, as the list of their fields' values in type hint
+    order, so field names aren't repeated in every value. The resulting lists, dicts and
+    primitives are serialized with `marshal`, and optionally compressed with zlib.
+
+    Fields can be added to the end of a class, but not reordered. Attributes that aren't type
+    hinted, and ClassVar and InitVar annotations, aren't stored.
+
+    `marshal`'s format may change between Python versions, so data should only be read back
+    by the version that wrote it, see `format_version`.
+    """
+    encode: Callable[[T], any]
+    decode: Callable[[any], T]
+    compression_level: Optional[int] = None
+
+    def dumps(self, obj: T) -> bytes:
+        data = marshal.dumps(self.encode(obj))
+        if self.compression_level is not None:
+            data = zlib.compress(data, self.compression_level)
+        return data
+
+    def loads(self, data: bytes) -> T:
+        if self.compression_level is not None:
+            data = zlib.decompress(data)
+        return self.decode(marshal.loads(data))
+
+
+def format_version() -> str:
+    """Identifies the marshal format that encoded data, which can only be decoded by the same format"""
+    return f'marshal {marshal.version}, Python {sys.version_info[0]}.{sys.version_info[1]}'
+
+
+_codecs: Dict[any, Tuple[Callable, Callable]] = {}
+_codecs_lock = threading.RLock()
+
+
+def codec_for(Class: Callable[[], T], compression_level: Optional[int]=None) -> BinaryCodec[T]:
+    try:
+        encode, decode = _codecs[Class]
+    except KeyError:
+        with _codecs_lock:
+            pending: Dict[any, Tuple[Callable, Callable]] = {}
+            encode, decode = _lookup(Class, pending)
+            _codecs.update(pending)
+
+    return BinaryCodec(encode, decode, compression_level)
+
+
+def _lookup(Class, pending: Dict[any, Tuple[Callable, Callable]]) -> Tuple[Callable, Callable]:
+    if Class in _codecs:
+        return _codecs[Class]
+
+    if Class in pending:
+        return pending[Class]
+
+    return _compile(Class, pending)
+
+
+def _compile(Class, pending: Dict[any, Tuple[Callable, Callable]]) -> Tuple[Callable, Callable]:
+    # Anything that isn't stored positionally is stored as its normalized JSON structure
+    json_codec = json.codec_for(Class)
+    origin = get_origin(Class)
+    type_args = get_args(Class)
+
+    if origin in (list, set) and len(type_args) > 0:
+        encode_item, decode_item = _lookup(type_args[0], pending)
+        container = origin
+
+        def encode(obj):
+            if type(obj) is not list and type(obj) is not set:
+                return json.normalize(obj)
+            return [encode_item(item) for item in obj]
+
+        def decode(obj):
+            if type(obj) is not list:
+                return json_codec.decode(obj)
+            return container([decode_item(item) for item in obj])
+
+        pending[Class] = (encode, decode)
+        return encode, decode
+
+    if origin == dict and len(type_args) > 0 and type_args[0] in (str, json.Interned):
+        encode_value, decode_value = _lookup(type_args[1], pending)
+
+        def encode(obj):
+            if type(obj) is not dict:
+                return json.normalize(obj)
+            return {key: encode_value(value) for key, value in obj.items() if value is not None}
+
+        def decode(obj):
+            if type(obj) is not dict:
+                return json_codec.decode(obj)
+            return {key: decode_value(value) for key, value in obj.items()}
+
+        if type_args[0] is json.Interned:
+            def decode(obj):
+                if type(obj) is not dict:
+                    return json_codec.decode(obj)
+                return {sys.intern(key): decode_value(value) for key, value in obj.items()}
+
+        pending[Class] = (encode, decode)
+        return encode, decode
+
+    if origin is not None or Class is None or Class is Any or Class in normal_types or Class in (list, set, dict):
+        pending[Class] = (json_codec.encode, json_codec.decode)
+        return pending[Class]
+
+    # python objects
+    try:
+        type_hints = get_type_hints(Class)
+    except Exception:
+        pending[Class] = (json_codec.encode, json_codec.decode)
+        return pending[Class]
+
+    # Filled in below, after this codec is registered, so that recursive types resolve to it
+    fields: List[Tuple[str, Callable, Callable]] = []
+
+    def encode(obj):
+        if type(obj) is not Class:
+            return json.normalize(obj)
+
+        values = []
+        for var_name, encode_field, decode_field in fields:
+            value = getattr(obj, var_name, None)
+            values.append(None if value is None else encode_field(value))
+        return values
+
+    def decode(obj):
+        if type(obj) is not list:
+            # Normalized JSON, e.g. a subclass instance
+            return json_codec.decode(obj)
+
+        return Class(**{var_name: decode_field(value) for (var_name, encode_field, decode_field), value in zip(fields, obj) if value is not None})
+
+    pending[Class] = (encode, decode)
+
+    for var_name, type_hint in type_hints.items():
+        # Class attributes and init-only arguments aren't fields of the instances
+        if get_origin(type_hint) is ClassVar or type_hint is ClassVar or isinstance(type_hint, InitVar) or type_hint is InitVar:
+            continue
+        encode_field, decode_field = _lookup(type_hint, pending)
+        fields.append((var_name, encode_field, decode_field))
+
+    return encode, decode
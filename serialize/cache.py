@@ -0,0 +1,92 @@
+from dataclasses import *
+from typing import *
+import collections
+import threading
+import time
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    invalidations: int = 0
+    size: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+
+class LRUCache(Generic[K, V]):
+    """Thread-safe LRU cache holding at most `max_size` entries, each for at most `ttl` seconds"""
+    max_size: int
+    ttl: Optional[float]
+
+    def __init__(self, max_size: int, ttl: Optional[float]=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (expiry time, value)
+        self.entries: collections.OrderedDict = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = CacheStats()
+        # Incremented by every invalidation, see `put`
+        self.generation = 0
+
+    def get(self, key: K) -> Optional[V]:
+        """Returns the cached value, or None if it isn't cached"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats.misses += 1
+                return None
+
+            expires, value = entry
+            if expires is not None and expires < time.monotonic():
+                del self.entries[key]
+                self.stats.expirations += 1
+                self.stats.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.stats.hits += 1
+            return value
+
+    def put(self, key: K, value: V, generation: Optional[int]=None):
+        """Caches `value`
+
+        Args:
+            generation (int, optional): The `generation` read before `value` was loaded. If anything
+                was invalidated since, `value` may be stale and isn't cached.
+        """
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.stats.evictions += 1
+
+    def invalidate(self, keys: Iterable[K]):
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                if self.entries.pop(key, None) is not None:
+                    self.stats.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.stats.invalidations += len(self.entries)
+            self.entries.clear()
+
+    def get_stats(self) -> CacheStats:
+        with self.lock:
+            return replace(self.stats, size=len(self.entries))
@@ -1,9 +1,26 @@
 import sqlite3
 from serialize import json
+from serialize import binary
+from serialize import query
+from serialize import instrument
+from serialize.cache import LRUCache, CacheStats
 from typing import *
 from dataclasses import *
 import logging
+import os
+import array
+import collections
 import collections.abc
+import concurrent.futures
+import itertools
+import queue
+import threading
+import contextlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # 1. insert rows
 
@@ -25,62 +42,303 @@ def get_values(obj: any, key_path: str):
         return [obj]
 
 
+def json_path_expression(key_path: str) -> str:
+    return f"json_extract(json, '$.{key_path}')"
+
+
+def batches(iterable: Iterable[T], batch_size: int) -> Iterator[List[T]]:
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+storage_formats = ['json', 'binary', 'binary-zlib']
+
+# Key/value settings of the database, like its storage format. Index tables are named after their
+# key path, so internal tables have names that key paths don't produce, or are refused.
+metadata_table = 'serialize_metadata'
+reserved_table_names = ['objects', 'indexes', metadata_table]
+
+# array typecodes of the key path types read into typed columns
+column_typecodes = {int: 'q', float: 'd'}
+
+
+def storage_codec(storage: str, datatype: Callable[..., T], decode_as: Optional[str]=None, intern_strings: bool=True) -> Union[json.Codec[T], binary.BinaryCodec[T]]:
+    """Returns the codec that stores `datatype` objects in the `objects` table in the `storage` format
+
+    With `decode_as`, objects are decoded to `json.compact_type(datatype, decode_as, intern_strings)`.
+    """
+    if storage == 'json':
+        codec_for = json.codec_for
+    elif storage == 'binary':
+        codec_for = binary.codec_for
+    elif storage == 'binary-zlib':
+        codec_for = lambda Class: binary.codec_for(Class, compression_level=6)
+    else:
+        raise Exception(f'Unknown storage format {storage}, expected one of {storage_formats}')
+
+    codec = codec_for(datatype)
+    if decode_as is not None:
+        codec = replace(codec, decode=codec_for(json.compact_type(datatype, decode_as, intern_strings)).decode)
+    return codec
+
+
+# Each worker process's connection to each database file
+worker_connections: Dict[str, sqlite3.Connection] = {}
+
+
+def decode_id_range(filename: str, datatype: Callable[..., T], storage: str, decode_as: Optional[str], intern_strings: bool, first_id: int, last_id: int, conditions: List[str], parameters: List[any], with_ids: bool) -> List:
+    """Reads and decodes the objects with ids in [first_id, last_id] matching `conditions`, in a worker process"""
+    conn = worker_connections.get(filename)
+    if conn is None:
+        conn = sqlite3.connect(filename)
+        conn.execute('pragma query_only = on')
+        worker_connections[filename] = conn
+
+    cmd = 'select id, json from objects where ' + ' and '.join(['id between ? and ?'] + conditions) + ' order by id'
+    loads = storage_codec(storage, datatype, decode_as, intern_strings).loads
+    rows = conn.execute(cmd, [first_id, last_id] + parameters)
+
+    if with_ids:
+        return [(id, loads(s)) for id, s in rows]
+    else:
+        return [loads(s) for id, s in rows]
+
+
+def index_values(datatype: Callable[..., T], storage: str, key_path: str, rows: List[Tuple[int, any]]) -> List[Tuple[int, any]]:
+    """Returns the (id, value) index entries at `key_path` of the stored objects in `rows`, possibly in a worker process"""
+    loads = storage_codec(storage, datatype).loads
+    index_rows = []
+    for id, s in rows:
+        values = get_values(loads(s), key_path)
+        if values is not None:
+            index_rows.extend((id, value) for value in values)
+    return index_rows
+
+
+@dataclass
+class ReaderLease:
+    """A reader connection lent to a thread, returned to the pool when the thread's last read using it finishes"""
+    conn: sqlite3.Connection
+    depth: int = 0
+
+
 class Database(Generic[T]):
     datatype: Callable[..., T]
+    codec: Union[json.Codec[T], binary.BinaryCodec[T]]
+    storage: str
     conn: sqlite3.Connection
+    cache: Optional[LRUCache[int, T]]
+    pool_size: int
+
+
+    def __init__(self, datatype: Callable[..., T], filename: str='data.db', cache_size: int=0, cache_ttl: Optional[float]=None,
+                 storage: Optional[str]=None, pool_size: int=0, journal_mode: Optional[str]=None, synchronous: Optional[str]=None, sqlite_cache_size: Optional[int]=None, mmap_size: Optional[int]=None,
+                 slow_query_seconds: Optional[float]=None, decode_as: Optional[str]=None, intern_strings: bool=True, pool_timeout: Optional[float]=60):
+        """
+        Args:
+            datatype: Type of the stored objects
+            filename (str, optional): SQLite database file. Defaults to 'data.db'.
+            cache_size (int, optional): Number of decoded objects to keep in an LRU cache keyed by id,
+                0 for no cache. Cached objects are shared between queries, so don't mutate them. Defaults to 0.
+            cache_ttl (float, optional): Seconds a cached object stays valid. Defaults to no expiry.
+            storage (str, optional): How objects are stored, one of `storage_formats`: 'json' text, or a compact
+                'binary' encoding (see `serialize.binary`), optionally zlib compressed. The format is recorded in
+                the database when it's created. Defaults to the recorded format, or 'json' for a new database.
+            pool_size (int, optional): Number of reader connections for use from multiple threads, 0 for a
+                single connection. Each read borrows a reader connection for as long as it runs, including
+                while a query's results are iterated, and writes go through one writer connection behind a
+                lock. Defaults to 0.
+            pool_timeout (float, optional): Seconds a read waits for a reader connection when all `pool_size`
+                are lent out before raising, None to wait indefinitely. Defaults to 60.
+            journal_mode (str, optional): `pragma journal_mode`. Defaults to 'wal' when pooled, so readers don't block the writer.
+            synchronous (str, optional): `pragma synchronous`, e.g. 'normal'
+            sqlite_cache_size (int, optional): `pragma cache_size` of each connection
+            mmap_size (int, optional): `pragma mmap_size` of each connection
+            slow_query_seconds (float, optional): Log a warning for statements taking at least this long,
+                including fetching their rows. See `serialize.instrument` for profiling all operations.
+            decode_as (str, optional): Decode objects to the memory-efficient `json.compact_type` of `datatype`
+                of this kind, 'slots' or 'tuple', instead of to `datatype`. Defaults to `datatype`.
+            intern_strings (bool, optional): With `decode_as`, intern decoded strings. Defaults to True.
+        """
+        self.filename = filename
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.slow_query_seconds = slow_query_seconds
+        self.pragmas: Dict[str, any] = {'foreign_keys': 'on'}
+        if sqlite_cache_size is not None:
+            self.pragmas['cache_size'] = sqlite_cache_size
+        if mmap_size is not None:
+            self.pragmas['mmap_size'] = mmap_size
+
+        if journal_mode is None and pool_size > 0:
+            journal_mode = 'wal'
 
+        self.write_lock = threading.RLock()
+        self.conn = self.connect(check_same_thread=pool_size == 0)
+        if journal_mode is not None:
+            self.conn.execute(f'pragma journal_mode = {journal_mode}')
+        if synchronous is not None:
+            self.conn.execute(f'pragma synchronous = {synchronous}')
+
+        # Reader connections not lent out, and the reader lent to each thread by thread id
+        self.readers: queue.Queue = queue.Queue()
+        self.reader_count = 0
+        self.pool_lock = threading.Lock()
+        self.leases: Dict[int, ReaderLease] = {}
 
-    def __init__(self, datatype: Callable[..., T], filename: str='data.db'):
-        self.conn = sqlite3.connect(filename)
         self.datatype = datatype
-        self.init_db()
+        self.decode_as = decode_as
+        self.intern_strings = intern_strings
+        self.cache = LRUCache(cache_size, cache_ttl) if cache_size > 0 else None
+        self.init_db(storage)
 
 
-    def init_db(self):
-        self.conn.execute('pragma foreign_keys = on')
-        self.conn.execute('create table if not exists objects (id integer primary key, json text)')
+    def connect(self, check_same_thread: bool=False, query_only: bool=False) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.filename, check_same_thread=check_same_thread, factory=instrument.ProfiledConnection)
+        conn.slow_query_seconds = self.slow_query_seconds
+        conn.logger = l
+        for name, value in self.pragmas.items():
+            conn.execute(f'pragma {name} = {value}')
+        if query_only:
+            conn.execute('pragma query_only = on')
+        return conn
 
-        self.conn.execute('create table if not exists indexes (table_name text, key_path text, unique(table_name), unique(key_path))')
 
-        self.conn.commit()
+    @contextlib.contextmanager
+    def reader(self) -> Iterator[sqlite3.Connection]:
+        """Lends a connection for reads for the duration of the `with` block
 
+        In pooled mode the connection goes back to the pool at the end of the block, so a generator reading
+        inside it holds its reader until it's exhausted or closed. Nested reads on a thread, like a `get`
+        while iterating a `select`, share the thread's reader rather than waiting for a second one.
+        """
+        if self.pool_size == 0:
+            yield self.conn
+            return
 
-    def insert(self, new_item: T):
-        cur = self.conn.cursor()
-        cur.execute('insert into objects (json) values (?)', (json.dumps(new_item), ))
-        self.conn.commit()
-        id = cur.lastrowid
+        thread = threading.get_ident()
+        with self.pool_lock:
+            lease = self.leases.get(thread)
+        if lease is None:
+            lease = ReaderLease(self.take_reader())
+            with self.pool_lock:
+                self.leases[thread] = lease
 
-        # Add index entries
-        for row in self.conn.execute('select table_name, key_path from indexes'):
-            table_name, key_path = row
-            values = get_values(new_item, key_path)
-            if values is None:
-                continue
+        with self.pool_lock:
+            lease.depth += 1
+        try:
+            yield lease.conn
+        finally:
+            with self.pool_lock:
+                lease.depth -= 1
+                returned = lease.depth == 0
+                if returned:
+                    del self.leases[thread]
+            if returned:
+                self.readers.put(lease.conn)
 
-            for value in get_values(new_item, key_path):
-                cur.execute(f'insert into {table_name} (id, value) values (?, ?)', (id, value))
-        self.conn.commit()
 
-    
-    def fetchall(self):
-        rows = self.conn.execute('select json from objects')
-        return [json.loads(row[0], self.datatype) for row in rows]
+    def reading(self) -> bool:
+        """Whether the calling thread has a read in progress, whose snapshot nested reads see"""
+        if self.pool_size == 0:
+            return False
+        with self.pool_lock:
+            return threading.get_ident() in self.leases
 
 
-    def fetchall_with_ids(self):
-        rows = self.conn.execute('select id, json from objects')
-        return [(row[0], json.loads(row[1], self.datatype)) for row in rows]
+    def take_reader(self) -> sqlite3.Connection:
+        """Takes a reader connection from the pool, opening one while there are fewer than `pool_size`"""
+        with self.pool_lock:
+            create = self.readers.empty() and self.reader_count < self.pool_size
+            if create:
+                self.reader_count += 1
+        if create:
+            return self.connect(query_only=True)
 
+        try:
+            return self.readers.get(timeout=self.pool_timeout)
+        except queue.Empty:
+            raise Exception(f'Timed out after {self.pool_timeout} s waiting for one of the {self.pool_size} reader connections of {self.filename}, are query results left unfinished?')
 
-    def create_index(self, key_path: str):
-        if self.conn.execute(f'select key_path from indexes where key_path is ?', (key_path,)).fetchone() is not None:
-            l.warning(f'Index already exists for {key_path}')
-            return
 
+    def close(self):
+        """Closes the writer connection and the readers not lent out"""
+        with self.write_lock:
+            self.conn.close()
+
+        while not self.readers.empty():
+            self.readers.get().close()
+
+
+    def init_db(self, storage: Optional[str]=None):
+        with self.write_lock:
+            self.conn.execute('create table if not exists objects (id integer primary key, json text)')
+
+            # Earlier versions named the metadata table `metadata`, which index tables can be named too
+            tables = [row[0] for row in self.conn.execute("select name from sqlite_master where type = 'table'")]
+            if metadata_table not in tables and 'metadata' in tables:
+                metadata_columns = [row[1] for row in self.conn.execute('pragma table_info(metadata)')]
+                if metadata_columns == ['key', 'value']:
+                    self.conn.execute(f'alter table metadata rename to {metadata_table}')
+
+            # Databases created before the metadata table existed store JSON
+            self.conn.execute(f'create table if not exists {metadata_table} (key text primary key, value text)')
+            row = self.conn.execute(f"select value from {metadata_table} where key = 'storage'").fetchone()
+            if row is None:
+                has_objects = self.conn.execute('select 1 from objects limit 1').fetchone() is not None
+                recorded_storage = 'json' if has_objects or storage is None else storage
+                # Check the format exists before recording it
+                storage_codec(recorded_storage, self.datatype)
+                self.conn.execute(f"insert into {metadata_table} (key, value) values ('storage', ?)", (recorded_storage,))
+            else:
+                recorded_storage = row[0]
+
+            if storage is not None and storage != recorded_storage:
+                raise Exception(f'Database {self.filename} uses {recorded_storage} storage, not {storage}')
+
+            if recorded_storage != 'json':
+                # Binary data can only be decoded by the marshal format that encoded it
+                row = self.conn.execute(f"select value from {metadata_table} where key = 'binary_format'").fetchone()
+                if row is None:
+                    self.conn.execute(f"insert into {metadata_table} (key, value) values ('binary_format', ?)", (binary.format_version(),))
+                elif row[0] != binary.format_version():
+                    raise Exception(f'Database {self.filename} was written with {row[0]}, which may not be readable with {binary.format_version()}')
+
+            self.storage = recorded_storage
+            self.codec = storage_codec(self.storage, self.datatype, self.decode_as, self.intern_strings)
+
+            self.conn.execute('create table if not exists indexes (table_name text, key_path text, expression text, backfilled_id integer, unique(table_name), unique(key_path))')
+
+            # Databases created before expression indexes existed only have side tables
+            index_columns = [row[1] for row in self.conn.execute('pragma table_info(indexes)')]
+            if 'expression' not in index_columns:
+                self.conn.execute('alter table indexes add column expression text')
+
+            # The last id backfilled into an index table being built, null once it's complete
+            if 'backfilled_id' not in index_columns:
+                self.conn.execute('alter table indexes add column backfilled_id integer')
+
+            self.conn.commit()
+
+
+    def get_indexes(self) -> List[Tuple[str, str, Optional[str]]]:
+        """Returns (table_name, key_path, expression) for each index
+
+        `expression` is the indexed `json_extract` expression for scalar key paths,
+        or None for key paths that fan out into a side table.
+        """
+        return self.conn.execute('select table_name, key_path, expression from indexes').fetchall()
+
+
+    def get_key_path_type(self, key_path: str) -> Tuple[any, List[int]]:
+        """Returns the type of the values at `key_path`, and the positions of the list/set components along it"""
         key_path_components = key_path.split('.')
+        fan_out_positions: List[int] = []
 
-        # Get the type of this key path
         type_hints = get_type_hints(self.datatype)
         for index, key_path_component in enumerate(key_path_components):
             datatype = type_hints[key_path_component]
@@ -90,9 +348,462 @@ class Database(Generic[T]):
             origin_type = get_origin(datatype)
             if origin_type in [list, set]:
                 datatype = get_args(datatype)[0]
+                fan_out_positions.append(index)
 
             type_hints = get_type_hints(datatype)
 
+        return datatype, fan_out_positions
+
+
+    def condition_sql(self, key_path: str, condition: str) -> str:
+        """Returns SQL, in terms of the `objects` table, that's true when a value at `key_path` satisfies `condition` (e.g. '< ?')
+
+        Indexes are used where they exist, otherwise the JSON is queried directly.
+        """
+        with self.reader() as conn:
+            row = conn.execute('select table_name, expression from indexes where key_path is ? and backfilled_id is null', (key_path,)).fetchone()
+        if row is not None:
+            table_name, expression = row
+            if expression is not None:
+                return f'{expression} {condition}'
+            else:
+                return f'id in (select id from {table_name} where value {condition})'
+
+        if self.storage != 'json':
+            raise Exception(f'Key path {key_path} must be indexed to query it with {self.storage} storage')
+
+        datatype, fan_out_positions = self.get_key_path_type(key_path)
+        if len(fan_out_positions) == 0:
+            return f'{json_path_expression(key_path)} {condition}'
+
+        if len(fan_out_positions) > 1:
+            raise Exception(f'Key path {key_path} has nested lists, create an index on it to query it')
+
+        # Test each element of the list
+        key_path_components = key_path.split('.')
+        list_key_path = '.'.join(key_path_components[:fan_out_positions[0] + 1])
+        item_key_path = '.'.join(key_path_components[fan_out_positions[0] + 1:])
+        if item_key_path == '':
+            item_expression = 'item.value'
+        else:
+            item_expression = f"json_extract(item.value, '$.{item_key_path}')"
+
+        return f"exists (select 1 from json_each(objects.json, '$.{list_key_path}') as item where {item_expression} {condition})"
+
+
+    def order_by_sql(self, key_path: str) -> str:
+        """Returns the order by term for `key_path`, which is descending if prefixed with '-'"""
+        direction = 'asc'
+        if key_path.startswith('-'):
+            key_path = key_path[1:]
+            direction = 'desc'
+
+        if key_path == 'id':
+            return f'id {direction}'
+
+        if self.storage != 'json':
+            raise Exception(f'Cannot order by {key_path} with {self.storage} storage, only by id')
+
+        datatype, fan_out_positions = self.get_key_path_type(key_path)
+        if len(fan_out_positions) > 0:
+            raise Exception(f'Cannot order by {key_path}, it has multiple values per object')
+
+        return f'{json_path_expression(key_path)} {direction}'
+
+
+    def where_sql(self, where: Union[str, query.Predicate, None], conditional: Optional[str]=None) -> Tuple[List[str], List[any]]:
+        """Compiles `where` into a list of SQL conditions and their parameters
+
+        `where` is either a Predicate, or a key path with a raw SQL `conditional`.
+        """
+        if where is None:
+            return [], []
+
+        if isinstance(where, str):
+            where = query.sql(where, conditional)
+
+        sql, parameters = where.to_sql(self.condition_sql)
+        return [sql], parameters
+
+
+    @instrument.instrumented('Database.insert')
+    def insert(self, new_item: T) -> int:
+        return self.insert_many([new_item])[0]
+
+
+    @instrument.instrumented('Database.insert_many')
+    def insert_many(self, new_items: Iterable[T], batch_size: int=1000) -> List[int]:
+        """Inserts `new_items` in a single transaction, returning the assigned ids
+
+        Objects are encoded `batch_size` at a time, and each batch is written to
+        `objects` and to every index table with one `executemany` per table.
+        """
+        with self.write_lock:
+            ids: List[int] = []
+            indexes = self.get_indexes()
+
+            codec = instrument.codec(self.codec)
+            cur = self.conn.cursor()
+            if not self.conn.in_transaction:
+                cur.execute('begin immediate')
+            try:
+                # Ids are allocated up front, which is safe because we hold the write lock
+                next_id = cur.execute('select coalesce(max(id), 0) + 1 from objects').fetchone()[0]
+
+                for batch in batches(new_items, batch_size):
+                    batch_ids = range(next_id, next_id + len(batch))
+                    next_id += len(batch)
+
+                    cur.executemany('insert into objects (id, json) values (?, ?)', zip(batch_ids, [codec.dumps(item) for item in batch]))
+
+                    # Add index entries (expression indexes are maintained by SQLite)
+                    for table_name, key_path, expression in indexes:
+                        if expression is not None:
+                            continue
+
+                        index_rows = []
+                        for id, item in zip(batch_ids, batch):
+                            values = get_values(item, key_path)
+                            if values is None:
+                                continue
+                            index_rows.extend((id, value) for value in values)
+
+                        cur.executemany(f'insert into {table_name} (id, value) values (?, ?)', index_rows)
+
+                    ids.extend(batch_ids)
+
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+
+            return ids
+
+    
+    @instrument.instrumented('Database.update')
+    def update(self, id: int, new_item: T):
+        self.update_many([(id, new_item)])
+
+
+    @instrument.instrumented('Database.update_many')
+    def update_many(self, items: Iterable[Tuple[int, T]], batch_size: int=1000):
+        """Replaces the objects with the given ids, keeping their ids, in a single transaction
+
+        Only the side-table index entries whose values changed are deleted or inserted;
+        expression indexes are updated by SQLite along with the JSON.
+        """
+        with self.write_lock:
+            indexes = [(table_name, key_path) for table_name, key_path, expression in self.get_indexes() if expression is None]
+            codec = instrument.codec(self.codec)
+
+            updated_ids: List[int] = []
+            cur = self.conn.cursor()
+            if not self.conn.in_transaction:
+                cur.execute('begin immediate')
+            try:
+                for batch in batches(items, batch_size):
+                    # The last update of an id wins
+                    new_items = dict(batch)
+                    ids = list(new_items.keys())
+                    # Looked up in batches of 500 ids, under SQLite's default limit of 999 variables before 3.32
+                    id_batches = [(id_batch, ', '.join(['?'] * len(id_batch))) for id_batch in batches(ids, 500)]
+
+                    existing_ids = set(row[0] for id_batch, placeholders in id_batches for row in cur.execute(f'select id from objects where id in ({placeholders})', id_batch))
+                    missing_ids = [id for id in ids if id not in existing_ids]
+                    if len(missing_ids) > 0:
+                        raise Exception(f'No objects with ids {missing_ids}')
+
+                    cur.executemany('update objects set json = ? where id = ?', [(codec.dumps(new_item), id) for id, new_item in new_items.items()])
+
+                    for table_name, key_path in indexes:
+                        old_values: Dict[int, Set] = {id: set() for id in ids}
+                        for id_batch, placeholders in id_batches:
+                            for id, value in cur.execute(f'select id, value from {table_name} where id in ({placeholders})', id_batch):
+                                old_values[id].add(value)
+
+                        removed_rows = []
+                        added_rows = []
+                        for id, new_item in new_items.items():
+                            new_values = set(get_values(new_item, key_path) or [])
+                            removed_rows.extend((id, value) for value in old_values[id] - new_values)
+                            added_rows.extend((id, value) for value in new_values - old_values[id])
+
+                        cur.executemany(f'delete from {table_name} where id = ? and value is ?', removed_rows)
+                        cur.executemany(f'insert into {table_name} (id, value) values (?, ?)', added_rows)
+
+                    updated_ids.extend(ids)
+
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+
+            # Only once committed, so readers can't cache the old objects again
+            if self.cache is not None:
+                self.cache.invalidate(updated_ids)
+
+
+    @instrument.instrumented('Database.upsert')
+    def upsert(self, key_path: str, new_item: T) -> int:
+        """Updates the object with the same value at `key_path` as `new_item`, or inserts `new_item` if there isn't one
+
+        Returns:
+            int: The id of the updated or inserted object
+        """
+        values = get_values(new_item, key_path)
+        if values is None or len(values) != 1:
+            raise Exception(f'Upsert needs a single value at {key_path}, got {values}')
+
+        with self.write_lock:
+            conditions, parameters = self.where_sql(query.eq(key_path, list(values)[0]))
+
+            cur = self.conn.cursor()
+            if not self.conn.in_transaction:
+                cur.execute('begin immediate')
+            try:
+                ids = [row[0] for row in cur.execute(f'select id from objects where {conditions[0]}', parameters)]
+                if len(ids) > 1:
+                    raise Exception(f'Upsert found {len(ids)} objects with the same {key_path}')
+
+                if len(ids) == 1:
+                    self.update_many([(ids[0], new_item)])
+                    return ids[0]
+                else:
+                    return self.insert_many([new_item])[0]
+            except BaseException:
+                self.conn.rollback()
+                raise
+
+
+    def _fetch(self, columns: str, from_clause: str, conditions: List[str], params: List[any], after_id: Optional[int], limit: Optional[int], batch_size: int, order_by: List[str]=[]) -> Iterator[tuple]:
+        """Runs a query over `objects`, yielding its rows `batch_size` at a time
+
+        `after_id` and `limit` page through the results in id order (keyset pagination).
+        """
+        if after_id is not None and order_by not in ([], ['id asc']):
+            raise Exception('after_id pages through results in id order, it cannot be combined with order_by')
+        params = list(params)
+
+        if after_id is not None:
+            conditions = conditions + ['id > ?']
+            params.append(after_id)
+
+        cmd = f'select {columns} from {from_clause}'
+        if len(conditions) > 0:
+            cmd += ' where ' + ' and '.join(conditions)
+
+        if len(order_by) > 0:
+            cmd += ' order by ' + ', '.join(order_by + ['id'])
+        elif after_id is not None or limit is not None:
+            cmd += ' order by id'
+
+        if limit is not None:
+            cmd += ' limit ?'
+            params.append(limit)
+
+        with self.reader() as conn:
+            cur = conn.execute(cmd, params)
+            try:
+                while True:
+                    rows = cur.fetchmany(batch_size)
+                    if len(rows) == 0:
+                        return
+                    yield from rows
+            finally:
+                # Ends the read transaction of results left unfinished
+                cur.close()
+
+
+    def _decode(self, rows: Iterator[Tuple[int, str]], with_ids: bool, raw: bool) -> Iterator:
+        if raw:
+            return rows if with_ids else (row[1] for row in rows)
+
+        loads = instrument.codec(self.codec).loads
+        if with_ids:
+            return ((id, loads(s)) for id, s in rows)
+        else:
+            return (loads(s) for id, s in rows)
+
+
+    def _load(self, ids: Iterator[int], batch_size: int, with_ids: bool) -> Iterator:
+        """Resolves ids to objects through the cache, decoding only the objects that aren't cached"""
+        codec = instrument.codec(self.codec)
+        # Objects read before a concurrent update or delete is committed aren't cached. Reads nested in another
+        # read see the snapshot it started with, possibly before `generation`, so they aren't cached at all.
+        generation = self.cache.generation
+        cacheable = not self.reading()
+        for batch in batches(ids, batch_size):
+            found: Dict[int, T] = {}
+            missing: List[int] = []
+            for id in batch:
+                obj = self.cache.get(id)
+                if obj is None:
+                    missing.append(id)
+                else:
+                    found[id] = obj
+            instrument.record_cache(len(found), len(missing))
+
+            for missing_batch in batches(missing, 500):
+                placeholders = ', '.join(['?'] * len(missing_batch))
+                with self.reader() as conn:
+                    rows = conn.execute(f'select id, json from objects where id in ({placeholders})', missing_batch).fetchall()
+                for id, s in rows:
+                    obj = codec.loads(s)
+                    if cacheable:
+                        self.cache.put(id, obj, generation)
+                    found[id] = obj
+
+            for id in batch:
+                if id in found:
+                    yield (id, found[id]) if with_ids else found[id]
+
+
+    def _results(self, conditions: List[str], parameters: List[any], after_id: Optional[int], limit: Optional[int], batch_size: int, order_by: List[str], with_ids: bool, raw: bool) -> Iterator:
+        if self.cache is not None and not raw:
+            ids = (row[0] for row in self._fetch('id', 'objects', conditions, parameters, after_id, limit, batch_size, order_by))
+            return self._load(ids, batch_size, with_ids)
+
+        rows = self._fetch('id, json', 'objects', conditions, parameters, after_id, limit, batch_size, order_by)
+        return self._decode(rows, with_ids, raw)
+
+
+    @instrument.instrumented('Database.get')
+    def get(self, id: int) -> Optional[T]:
+        """Returns the object with `id`, or None if there isn't one"""
+        if self.cache is not None:
+            return next(self._load(iter([id]), 1, False), None)
+
+        with self.reader() as conn:
+            row = conn.execute('select json from objects where id is ?', (id,)).fetchone()
+        return instrument.codec(self.codec).loads(row[0]) if row is not None else None
+
+
+    def cache_stats(self) -> Optional[CacheStats]:
+        return self.cache.get_stats() if self.cache is not None else None
+
+
+    @instrument.instrumented('Database.iterate')
+    def iterate(self, after_id: Optional[int]=None, limit: Optional[int]=None, batch_size: int=1000, with_ids: bool=False, raw: bool=False) -> Iterator:
+        """Lazily yields the stored objects, decoding them as they're read
+
+        Args:
+            after_id (int, optional): Only yield objects with ids greater than this (keyset pagination)
+            limit (int, optional): Maximum number of objects to yield
+            batch_size (int, optional): Number of rows fetched from SQLite at a time. Defaults to 1000.
+            with_ids (bool, optional): Yield (id, object) tuples. Defaults to False.
+            raw (bool, optional): Yield the undecoded JSON strings (bytes with binary storage) instead of objects. Defaults to False.
+        """
+        return self._results([], [], after_id, limit, batch_size, [], with_ids, raw)
+
+
+    @instrument.instrumented('Database.iterate_ids')
+    def iterate_ids(self, after_id: Optional[int]=None, limit: Optional[int]=None, batch_size: int=1000) -> Iterator[int]:
+        for row in self._fetch('id', 'objects', [], [], after_id, limit, batch_size):
+            yield row[0]
+
+
+    @instrument.instrumented('Database.fetchall')
+    def fetchall(self, parallel: int=0):
+        if parallel > 0:
+            return list(self.scan_parallel(parallel))
+        return list(self.iterate())
+
+
+    @instrument.instrumented('Database.fetchall_with_ids')
+    def fetchall_with_ids(self, parallel: int=0):
+        if parallel > 0:
+            return list(self.scan_parallel(parallel, with_ids=True))
+        return list(self.iterate(with_ids=True))
+
+
+    @instrument.instrumented('Database.scan_parallel')
+    def scan_parallel(self, parallel: Optional[int]=None, where: Union[str, query.Predicate, None]=None, conditional: Optional[str]=None, chunk_size: int=10000, ordered: bool=True, with_ids: bool=False) -> Iterator:
+        """Yields the objects matching `where`, decoded by a pool of `parallel` worker processes
+
+        The id range is split into chunks of `chunk_size` ids, and each worker reads and decodes
+        its chunks through its own connection, so only committed objects are seen. `datatype` must be
+        importable by the workers (defined at module level). With `ordered=False` chunks are yielded
+        as they complete rather than in id order.
+        """
+        if self.filename == ':memory:':
+            raise Exception('Parallel scans need a database file')
+
+        conditions, parameters = self.where_sql(where, conditional)
+        with self.reader() as conn:
+            first_id, last_id = conn.execute('select min(id), max(id) from objects').fetchone()
+        if first_id is None:
+            return
+
+        ranges = ((start, min(start + chunk_size - 1, last_id)) for start in range(first_id, last_id + 1, chunk_size))
+
+        if parallel is None:
+            parallel = os.cpu_count() or 1
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=parallel) as executor:
+            max_pending = 2 * parallel
+            pending: collections.deque = collections.deque()
+
+            def submit(id_range: Tuple[int, int]):
+                pending.append(executor.submit(decode_id_range, self.filename, self.datatype, self.storage, self.decode_as, self.intern_strings, id_range[0], id_range[1], conditions, parameters, with_ids))
+
+            for id_range in itertools.islice(ranges, max_pending):
+                submit(id_range)
+
+            while len(pending) > 0:
+                if ordered:
+                    future = pending.popleft()
+                else:
+                    done, not_done = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    future = done.pop()
+                    pending.remove(future)
+
+                # Keep at most max_pending chunks in flight
+                for id_range in itertools.islice(ranges, 1):
+                    submit(id_range)
+
+                yield from future.result()
+
+
+    @instrument.instrumented('Database.create_index')
+    def create_index(self, key_path: str, chunk_size: int=10000, parallel: int=0):
+        """Indexes the values at `key_path`, so queries on it don't scan every object
+
+        Scalar key paths of JSON objects are indexed by SQLite on `json_extract`. Other key paths get an
+        index table, backfilled `chunk_size` objects at a time, each chunk in its own transaction so writers
+        only wait for one chunk. Progress is recorded in the `indexes` table, and the index is only used by
+        queries once complete; calling create_index again resumes an interrupted build.
+
+        Args:
+            chunk_size (int, optional): Number of objects backfilled per transaction. Defaults to 10000.
+            parallel (int, optional): Number of worker processes extracting the values of each chunk, 0 to
+                extract them in this thread. `datatype` must be importable by the workers. Defaults to 0.
+        """
+        with self.write_lock:
+            row = self.conn.execute('select table_name, backfilled_id from indexes where key_path is ?', (key_path,)).fetchone()
+            if row is not None and row[1] is None:
+                l.warning(f'Index already exists for {key_path}')
+                return
+
+            if row is not None:
+                table_name, backfilled_id = row
+                l.info(f'Resuming the build of the index on {key_path} after id {backfilled_id}')
+            else:
+                table_name = self.create_index_table(key_path)
+                if table_name is None:
+                    return
+                backfilled_id = 0
+
+        self.backfill_index(table_name, key_path, backfilled_id, chunk_size, parallel)
+
+
+    def create_index_table(self, key_path: str) -> Optional[str]:
+        """Creates and registers the index on `key_path`, returning the name of its index table to backfill,
+        or None for an expression index, which SQLite builds
+        """
+        # Get the type of this key path
+        datatype, fan_out_positions = self.get_key_path_type(key_path)
+        fan_out = len(fan_out_positions) > 0
+
         sql_type_strings = {
             str: 'text',
             int: 'integer',
@@ -103,6 +814,16 @@ class Database(Generic[T]):
 
 
         table_name = key_path.replace('.', '__')
+        if table_name in reserved_table_names:
+            raise Exception(f'Cannot index {key_path}, its index table would be the internal {table_name} table')
+
+        if not fan_out and self.storage == 'json':
+            # Scalar key paths are indexed directly on the JSON, so SQLite builds and maintains the index itself
+            expression = json_path_expression(key_path)
+            self.conn.execute(f'create index if not exists {table_name}_index on objects({expression})')
+            self.conn.execute('insert into indexes (table_name, key_path, expression) values (?, ?, ?)', (table_name, key_path, expression))
+            self.conn.commit()
+            return None
 
         # Create the index table
         self.conn.execute(f'''
@@ -110,37 +831,241 @@ class Database(Generic[T]):
             (id integer, value {sql_type_string}, foreign key(id) references objects(id) on delete cascade, unique(id, value))''')
         self.conn.execute(f'create index if not exists {table_name}_index on {table_name}(value)')
 
-        # Add entries for existing  items
-        for id, item in self.fetchall_with_ids():
-            for value in get_values(item, key_path):
-                self.conn.execute(f'insert into {table_name} (id, value) values (?, ?)', (id, value))
+        # Create the entry in the indexes table, referencing this index table. From here on writes
+        # maintain the index, while the objects already stored are backfilled.
+        self.conn.execute('insert into indexes (table_name, key_path, backfilled_id) values (?, ?, 0)', (table_name, key_path))
+        self.conn.commit()
+        return table_name
+
 
-        # Create the entry in the indexes table, referencing this index table
-        self.conn.execute('insert into indexes (table_name, key_path) values (?, ?)', (table_name, key_path))
+    def backfill_index(self, table_name: str, key_path: str, backfilled_id: int, chunk_size: int, parallel: int):
+        """Adds the index entries of the objects with ids after `backfilled_id`, one chunk per transaction"""
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=parallel) if parallel > 0 else None
+        try:
+            while True:
+                with self.write_lock:
+                    cur = self.conn.cursor()
+                    if not self.conn.in_transaction:
+                        cur.execute('begin immediate')
+                    try:
+                        # Read and index the chunk in one transaction, so no write can make its entries stale
+                        rows = cur.execute('select id, json from objects where id > ? order by id limit ?', (backfilled_id, chunk_size)).fetchall()
+                        if len(rows) == 0:
+                            cur.execute('update indexes set backfilled_id = null where key_path is ?', (key_path,))
+                            self.conn.commit()
+                            return
 
-        self.conn.commit()
+                        if executor is None:
+                            index_rows = index_values(self.datatype, self.storage, key_path, rows)
+                        else:
+                            worker_chunk_size = (len(rows) + parallel - 1) // parallel
+                            worker_chunks = [rows[start:start + worker_chunk_size] for start in range(0, len(rows), worker_chunk_size)]
+                            index_rows = []
+                            for worker_rows in executor.map(index_values, itertools.repeat(self.datatype), itertools.repeat(self.storage), itertools.repeat(key_path), worker_chunks):
+                                index_rows.extend(worker_rows)
 
+                        # Objects written since the index was registered already have their entries
+                        cur.executemany(f'insert or ignore into {table_name} (id, value) values (?, ?)', index_rows)
 
-    def select(self, key_path: str, conditional: str):
-        table_name = key_path.replace('.', '__')
+                        backfilled_id = rows[-1][0]
+                        cur.execute('update indexes set backfilled_id = ? where key_path is ?', (backfilled_id, key_path))
+                        self.conn.commit()
+                    except BaseException:
+                        self.conn.rollback()
+                        raise
+        finally:
+            if executor is not None:
+                executor.shutdown()
 
-        self.create_index(key_path)
 
-        cmd = f'select json from objects natural join {table_name} where value {conditional}'
+    @instrument.instrumented('Database.select')
+    def select(self, where: Union[str, query.Predicate, None]=None, conditional: Optional[str]=None, after_id: Optional[int]=None, limit: Optional[int]=None, order_by: Union[str, List[str], None]=None, batch_size: int=1000, with_ids: bool=False, raw: bool=False, fields: Optional[List[str]]=None):
+        """Yields the objects matching `where`
 
-        for row in self.conn.execute(cmd):
-            yield json.loads(row[0], self.datatype)
+        Args:
+            where (str | Predicate, optional): A Predicate built with `serialize.query`, or a key path
+                to test with the raw SQL `conditional`. Defaults to all objects.
+            conditional (str, optional): SQL condition on the key path's value, e.g. 'like "Allen%"'
+            after_id (int, optional): Only yield objects with ids greater than this, to page through results
+                in id order. Can't be combined with `order_by`.
+            order_by (str | List[str], optional): Key paths to order by, prefixed with '-' for descending order
+            fields (List[str], optional): Key paths to select, e.g. ['name', 'address.town']. Yields a dict of
+                each object's values at these key paths instead of the object, read in SQL without decoding
+                the whole object. Values at list/set key paths are lists. Defaults to whole objects.
+        """
+        conditions, parameters = self.where_sql(where, conditional)
+        if fields is not None:
+            yield from self._project(fields, conditions, parameters, after_id, limit, batch_size, self._order_by(order_by), with_ids)
+            return
 
+        yield from self._results(conditions, parameters, after_id, limit, batch_size, self._order_by(order_by), with_ids, raw)
 
-    def delete(self, key_path: str, conditional: str):
-        table_name = key_path.replace('.', '__')
 
-        self.create_index(key_path)
+    def field_sql(self, key_path: str) -> Tuple[str, Optional[Callable[[str], any]]]:
+        """Returns the SQL expression, in terms of the `objects` table, selecting the value at `key_path`,
+        and the function decoding it, or None if it's selected as is
 
-        cmd = f'delete from objects where id in (select id from {table_name} where value {conditional})'
+        Index tables are read where they exist, otherwise the value is extracted from the JSON.
+        """
+        datatype, fan_out_positions = self.get_key_path_type(key_path)
+        fan_out = len(fan_out_positions) > 0
 
-        self.conn.execute(cmd)
-        self.conn.commit()
+        with self.reader() as conn:
+            row = conn.execute('select table_name, expression from indexes where key_path is ? and backfilled_id is null', (key_path,)).fetchone()
+        if row is not None:
+            table_name, expression = row
+            if expression is not None:
+                return expression, None
+            if fan_out:
+                return f'(select json_group_array(value) from {table_name} where {table_name}.id = objects.id)', json.codec_for(List[datatype]).loads
+            return f'(select value from {table_name} where {table_name}.id = objects.id)', None
+
+        if self.storage != 'json':
+            raise Exception(f'Key path {key_path} must be indexed to select it with {self.storage} storage')
+
+        key_path_components = key_path.split('.')
+        if len(fan_out_positions) > 1 or (fan_out and fan_out_positions[0] != len(key_path_components) - 1):
+            raise Exception(f'Key path {key_path} has values inside a list, create an index on it to select it')
+
+        expression = json_path_expression(key_path)
+        if fan_out:
+            return expression, json.codec_for(List[datatype]).loads
+        if datatype in (int, str, float, bool):
+            return expression, None
+
+        # json_extract returns objects as JSON text
+        return expression, json.codec_for(datatype).loads
+
+
+    def _project(self, fields: List[str], conditions: List[str], parameters: List[any], after_id: Optional[int], limit: Optional[int], batch_size: int, order_by: List[str], with_ids: bool) -> Iterator:
+        expressions: List[str] = []
+        decoders: List[Tuple[str, Optional[Callable[[str], any]]]] = []
+        for key_path in fields:
+            expression, decode = self.field_sql(key_path)
+            expressions.append(expression)
+            decoders.append((key_path, decode))
+
+        columns = ', '.join(['id'] + expressions)
+        for row in self._fetch(columns, 'objects', conditions, parameters, after_id, limit, batch_size, order_by):
+            values = {}
+            for (key_path, decode), value in zip(decoders, row[1:]):
+                values[key_path] = decode(value) if decode is not None and value is not None else value
+            yield (row[0], values) if with_ids else values
+
+
+    @instrument.instrumented('Database.select_ids')
+    def select_ids(self, where: Union[str, query.Predicate, None]=None, conditional: Optional[str]=None, after_id: Optional[int]=None, limit: Optional[int]=None, order_by: Union[str, List[str], None]=None, batch_size: int=1000) -> Iterator[int]:
+        conditions, parameters = self.where_sql(where, conditional)
+        for row in self._fetch('id', 'objects', conditions, parameters, after_id, limit, batch_size, self._order_by(order_by)):
+            yield row[0]
+
+
+    def _order_by(self, order_by: Union[str, List[str], None]) -> List[str]:
+        if order_by is None:
+            return []
+
+        if isinstance(order_by, str):
+            order_by = [order_by]
+
+        return [self.order_by_sql(key_path) for key_path in order_by]
+
+
+    @instrument.instrumented('Database.column')
+    def column(self, key_path: str, where: Union[str, query.Predicate, None]=None, conditional: Optional[str]=None, batch_size: int=10000, as_numpy: bool=False) -> Tuple[any, any]:
+        """Returns the values at `key_path` of the objects matching `where`, and the ids of their objects, in id order
+
+        Values are read from the index on `key_path` where there is one, otherwise extracted from the JSON,
+        without decoding the objects. Objects without a value are left out, and list/set key paths give one
+        entry per element.
+
+        Args:
+            batch_size (int, optional): Number of rows fetched from SQLite at a time. Defaults to 10000.
+            as_numpy (bool, optional): Return NumPy arrays, which needs NumPy installed. Defaults to `array.array`s.
+
+        Returns:
+            Tuple: The ids, as an `array.array` of int64, and the values, as an `array.array` of int64 or float64
+                for int and float key paths, or a list of the values for other types.
+        """
+        if as_numpy and numpy is None:
+            raise Exception('as_numpy needs NumPy, which is not installed')
+
+        datatype, fan_out_positions = self.get_key_path_type(key_path)
+        conditions, parameters = self.where_sql(where, conditional)
+        where_clause = ' where ' + ' and '.join(conditions) if len(conditions) > 0 else ''
+
+        with self.reader() as conn:
+            row = conn.execute('select table_name, expression from indexes where key_path is ? and backfilled_id is null', (key_path,)).fetchone()
+        if row is not None and row[1] is None:
+            # Scan the index table in (id, value) order
+            table_name = row[0]
+            cmd = f'select id, value from {table_name}'
+            if len(conditions) > 0:
+                cmd += f' where id in (select id from objects{where_clause})'
+            cmd += ' order by id'
+        elif row is not None and len(conditions) == 0:
+            # Read the values from the expression index rather than extracting them from every object
+            table_name, expression = row
+            cmd = f'select id, value from (select id, {expression} as value from objects indexed by {table_name}_index where {expression} is not null) order by id'
+        elif row is not None or (self.storage == 'json' and len(fan_out_positions) == 0):
+            expression = row[1] if row is not None else json_path_expression(key_path)
+            cmd = f'select id, {expression} from objects where ' + ' and '.join(conditions + [f'{expression} is not null']) + ' order by id'
+        elif self.storage != 'json':
+            raise Exception(f'Key path {key_path} must be indexed to read its column with {self.storage} storage')
+        elif len(fan_out_positions) > 1:
+            raise Exception(f'Key path {key_path} has nested lists, create an index on it to read its column')
+        else:
+            # One row per list element
+            key_path_components = key_path.split('.')
+            list_key_path = '.'.join(key_path_components[:fan_out_positions[0] + 1])
+            item_key_path = '.'.join(key_path_components[fan_out_positions[0] + 1:])
+            expression = 'item.value' if item_key_path == '' else f"json_extract(item.value, '$.{item_key_path}')"
+            cmd = (f"select matches.id, {expression} from (select id, json from objects{where_clause}) as matches, json_each(matches.json, '$.{list_key_path}') as item "
+                   f'where {expression} is not null order by matches.id')
+
+        typecode = column_typecodes.get(datatype)
+        # json_extract returns objects as JSON text
+        decode = None if typecode is not None or datatype in (str, bool) else json.codec_for(datatype).loads
+
+        ids = array.array('q')
+        values = array.array(typecode) if typecode is not None else []
+        with self.reader() as conn:
+            cur = conn.execute(cmd, parameters)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if len(rows) == 0:
+                    break
+
+                batch_ids, batch_values = zip(*rows)
+                ids.extend(batch_ids)
+                values.extend(batch_values if decode is None else map(decode, batch_values))
+
+        if as_numpy:
+            ids = numpy.frombuffer(ids, dtype=numpy.int64)
+            values = numpy.frombuffer(values, dtype=numpy.dtype(typecode)) if typecode is not None else numpy.array(values, dtype=object)
+        return ids, values
+
+
+    @instrument.instrumented('Database.delete')
+    def delete(self, where: Union[str, query.Predicate], conditional: Optional[str]=None):
+        with self.write_lock:
+            conditions, parameters = self.where_sql(where, conditional)
+
+            ids = []
+            if self.cache is not None:
+                ids = [row[0] for row in self.conn.execute(f'select id from objects where {conditions[0]}', parameters)]
+
+            cmd = f'delete from objects where {conditions[0]}'
+
+            try:
+                self.conn.execute(cmd, parameters)
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+
+            # Only once committed, so readers can't cache the deleted objects again
+            if self.cache is not None:
+                self.cache.invalidate(ids)
 
 
 if __name__ == '__main__':
@@ -164,6 +1089,7 @@ if __name__ == '__main__':
 
     test_db.insert(Person("Ed", 45, Address(5, "Allens Drive", "Grantham", "NH"), hobbies=['programming', 'hiking']))
     print(list(test_db.select('address.street', 'like "Allen%"')))
+    print(list(test_db.select(query.eq('hobbies', 'hiking') & query.between('age', 40, 50), order_by='-age')))
     test_db.delete('address.town', 'like "Gran%"')
 
     print(list(test_db.fetchall()))
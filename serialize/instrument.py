@@ -0,0 +1,346 @@
+from dataclasses import *
+from typing import *
+import collections.abc
+import functools
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+l = logging.getLogger(__file__)
+
+
+@dataclass
+class OperationStats:
+    """What the calls of one operation, e.g. 'Database.select', did"""
+    name: str
+    calls: int = 0
+    seconds: float = 0.0
+    # Time spent in SQLite executing statements and fetching their rows
+    sqlite_seconds: float = 0.0
+    # Time spent encoding and decoding stored objects
+    codec_seconds: float = 0.0
+    statements: int = 0
+    # Rows fetched, plus rows changed by inserts, updates and deletes
+    rows: int = 0
+    cache_hits: int = 0
+    cache_misses: int = 0
+    # Number of times each SQL statement was issued
+    sql: Dict[str, int] = field(default_factory=dict)
+
+    @property
+    def other_seconds(self) -> float:
+        return self.seconds - self.sqlite_seconds - self.codec_seconds
+
+    def add(self, other: 'OperationStats'):
+        self.calls += other.calls
+        self.seconds += other.seconds
+        self.sqlite_seconds += other.sqlite_seconds
+        self.codec_seconds += other.codec_seconds
+        self.statements += other.statements
+        self.rows += other.rows
+        self.cache_hits += other.cache_hits
+        self.cache_misses += other.cache_misses
+        for sql, count in other.sql.items():
+            self.sql[sql] = self.sql.get(sql, 0) + count
+
+
+class Profile:
+    """Collects the OperationStats of the instrumented operations run, on any thread, while it's active
+
+        with Profile() as profile:
+            db.insert_many(people)
+            list(db.select(query.eq('age', 45)))
+        print(profile.report())
+
+    Time spent in operations called by another operation (e.g. `insert` calling `insert_many`)
+    is counted in the outermost one. Operations returning iterators are recorded until the
+    iterator is exhausted or closed.
+    """
+
+    def __init__(self, callback: Optional[Callable[[OperationStats], None]]=None):
+        """
+        Args:
+            callback (Callable[[OperationStats], None], optional): Called with the stats of each operation call as it completes
+        """
+        self.callback = callback
+        self.operations: Dict[str, OperationStats] = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        global active_profiles
+        with active_profiles_lock:
+            active_profiles = active_profiles + (self,)
+
+    def stop(self):
+        global active_profiles
+        with active_profiles_lock:
+            active_profiles = tuple(profile for profile in active_profiles if profile is not self)
+
+    def __enter__(self) -> 'Profile':
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def record(self, stats: OperationStats):
+        with self.lock:
+            if stats.name not in self.operations:
+                self.operations[stats.name] = OperationStats(stats.name)
+            self.operations[stats.name].add(stats)
+
+        if self.callback is not None:
+            self.callback(stats)
+
+    def report(self, statements_per_operation: int=5) -> str:
+        """Returns a table of the operations, slowest first, each followed by its most frequently issued statements"""
+        with self.lock:
+            operations = sorted(self.operations.values(), key=lambda stats: stats.seconds, reverse=True)
+
+        lines = [f'{"operation":28} {"calls":>7} {"total ms":>10} {"sqlite ms":>10} {"codec ms":>10} {"other ms":>10} {"statements":>10} {"rows":>9} {"cache hits":>10} {"misses":>8}']
+        for stats in operations:
+            lines.append(f'{stats.name:28} {stats.calls:7} {stats.seconds * 1000:10.1f} {stats.sqlite_seconds * 1000:10.1f} {stats.codec_seconds * 1000:10.1f} {stats.other_seconds * 1000:10.1f} '
+                         f'{stats.statements:10} {stats.rows:9} {stats.cache_hits:10} {stats.cache_misses:8}')
+
+            statements = sorted(stats.sql.items(), key=lambda item: item[1], reverse=True)
+            for sql, count in statements[:statements_per_operation]:
+                lines.append(f'    {count:7} x {sql}')
+
+        return '\n'.join(lines)
+
+
+# Replaced rather than modified, so it can be read without the lock
+active_profiles: Tuple[Profile, ...] = ()
+active_profiles_lock = threading.Lock()
+
+# The stats of the operation running on each thread
+local = threading.local()
+
+
+def statement_key(sql: str) -> str:
+    """Returns `sql` on one line, with long lists of placeholders shortened so statements differing only in batch size are counted together"""
+    return re.sub(r'\?(, \?){2,}', '?, ..., ?', ' '.join(sql.split()))
+
+
+def current() -> Optional[OperationStats]:
+    """Returns the stats of the operation being recorded on this thread, if any"""
+    return getattr(local, 'stats', None)
+
+
+def run(stats: OperationStats, function: Callable, *args, **kwargs):
+    previous = current()
+    local.stats = stats
+    start = time.perf_counter()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        stats.seconds += time.perf_counter() - start
+        local.stats = previous
+
+
+def finish(stats: OperationStats):
+    for profile in active_profiles:
+        profile.record(stats)
+
+
+def record_iterator(stats: OperationStats, iterator: Iterator) -> Iterator:
+    try:
+        while True:
+            try:
+                item = run(stats, next, iterator)
+            except StopIteration:
+                return
+            yield item
+    finally:
+        if hasattr(iterator, 'close'):
+            run(stats, iterator.close)
+        finish(stats)
+
+
+def instrumented(name: str):
+    """Decorator recording the calls of a function as the `name` operation while a Profile is active"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if len(active_profiles) == 0 or current() is not None:
+                return function(*args, **kwargs)
+
+            stats = OperationStats(name, calls=1)
+            try:
+                result = run(stats, function, *args, **kwargs)
+            except BaseException:
+                finish(stats)
+                raise
+
+            if isinstance(result, collections.abc.Iterator):
+                return record_iterator(stats, result)
+
+            finish(stats)
+            return result
+        return wrapper
+    return decorator
+
+
+def record_cache(hits: int, misses: int):
+    stats = current()
+    if stats is not None:
+        stats.cache_hits += hits
+        stats.cache_misses += misses
+
+
+class ProfiledCodec:
+    """Codec wrapper timing dumps and loads as codec time of the current operation"""
+
+    def __init__(self, codec, stats: OperationStats):
+        self.codec = codec
+        self.stats = stats
+
+    def dumps(self, obj: any):
+        start = time.perf_counter()
+        try:
+            return self.codec.dumps(obj)
+        finally:
+            self.stats.codec_seconds += time.perf_counter() - start
+
+    def loads(self, s: any):
+        start = time.perf_counter()
+        try:
+            return self.codec.loads(s)
+        finally:
+            self.stats.codec_seconds += time.perf_counter() - start
+
+
+def codec(codec):
+    """Returns `codec`, timed while an operation is being recorded on this thread"""
+    stats = current()
+    return codec if stats is None else ProfiledCodec(codec, stats)
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    """Cursor recording its statements in the current operation, and logging slow ones
+
+    A statement's time is its execution plus fetching its rows, up to when the cursor is
+    exhausted, closed or reused.
+    """
+    statement: Optional[str] = None
+    statement_seconds: float = 0.0
+
+    def execute(self, sql: str, parameters: Iterable=()) -> 'ProfiledCursor':
+        return self.run_statement(sql, super().execute, parameters)
+
+    def executemany(self, sql: str, parameters: Iterable) -> 'ProfiledCursor':
+        return self.run_statement(sql, super().executemany, parameters)
+
+    def executescript(self, script: str) -> 'ProfiledCursor':
+        return self.run_statement(script, super().executescript)
+
+    def run_statement(self, sql: str, execute: Callable, *args) -> 'ProfiledCursor':
+        self.finish_statement()
+        self.statement = sql
+        self.statement_seconds = 0.0
+
+        stats = current()
+        if stats is not None:
+            stats.statements += 1
+            key = statement_key(sql)
+            stats.sql[key] = stats.sql.get(key, 0) + 1
+
+        self.timed(execute, sql, *args)
+        if stats is not None and self.rowcount > 0:
+            stats.rows += self.rowcount
+        return self
+
+    def timed(self, function: Callable, *args):
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            seconds = time.perf_counter() - start
+            self.statement_seconds += seconds
+            stats = current()
+            if stats is not None:
+                stats.sqlite_seconds += seconds
+
+    def fetched(self, row_count: int, exhausted: bool):
+        stats = current()
+        if stats is not None:
+            stats.rows += row_count
+        if exhausted:
+            self.finish_statement()
+
+    def finish_statement(self):
+        if self.statement is None:
+            return
+
+        slow_query_seconds = getattr(self.connection, 'slow_query_seconds', None)
+        if slow_query_seconds is not None and self.statement_seconds >= slow_query_seconds:
+            logger = getattr(self.connection, 'logger', l)
+            logger.warning(f'Slow query ({self.statement_seconds * 1000:.1f} ms): {statement_key(self.statement)}')
+        self.statement = None
+
+    def fetchone(self):
+        row = self.timed(super().fetchone)
+        self.fetched(0 if row is None else 1, row is None)
+        return row
+
+    def fetchmany(self, size: Optional[int]=None):
+        if size is None:
+            size = self.arraysize
+        rows = self.timed(super().fetchmany, size)
+        self.fetched(len(rows), len(rows) < size)
+        return rows
+
+    def fetchall(self):
+        rows = self.timed(super().fetchall)
+        self.fetched(len(rows), True)
+        return rows
+
+    def __next__(self):
+        try:
+            row = self.timed(super().__next__)
+        except StopIteration:
+            self.fetched(0, True)
+            raise
+        self.fetched(1, False)
+        return row
+
+    def close(self):
+        self.finish_statement()
+        super().close()
+
+    def __del__(self):
+        self.finish_statement()
+
+
+class ProfiledConnection(sqlite3.Connection):
+    """Connection whose statements are recorded by active Profiles, and logged if they take at least `slow_query_seconds`
+
+    Pass it as the `factory` of `sqlite3.connect`. While no Profile is active and there's no
+    `slow_query_seconds`, its cursors are plain sqlite3 cursors.
+    """
+    slow_query_seconds: Optional[float] = None
+    logger: logging.Logger = l
+
+    def profiled(self) -> bool:
+        return len(active_profiles) > 0 or self.slow_query_seconds is not None
+
+    def cursor(self, factory: Optional[Callable]=None) -> sqlite3.Cursor:
+        if factory is None:
+            factory = ProfiledCursor if self.profiled() else sqlite3.Cursor
+        return super().cursor(factory)
+
+    # sqlite3.Connection's shortcuts don't go through cursor()
+    def execute(self, sql: str, parameters: Iterable=()) -> sqlite3.Cursor:
+        if not self.profiled():
+            return super().execute(sql, parameters)
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql: str, parameters: Iterable) -> sqlite3.Cursor:
+        if not self.profiled():
+            return super().executemany(sql, parameters)
+        return self.cursor().executemany(sql, parameters)
+
+    def executescript(self, script: str) -> sqlite3.Cursor:
+        return self.cursor().executescript(script)
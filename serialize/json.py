@@ -3,14 +3,43 @@
 from dataclasses import *
 from typing import *
 import json
+import atexit
+import codecs
+import collections
+import hashlib
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import weakref
+
+l = logging.getLogger(__file__)
 
 normal_types = set([int, float, str, bool, type(None)])
 
+# str whose decoded values are interned, so equal strings share one object (see `compact_type`)
+Interned = NewType('Interned', str)
+
 T = TypeVar("T")
 
 def normalize(obj: any):
     t = type(obj)
 
+    if t in normal_types:
+        return obj
+
+    return codec_for(t).encode(obj)
+
+
+def denormalize(obj: any, Class: Callable[[], T]) -> T:
+    return codec_for(Class).decode(obj)
+
+
+def _normalize(obj: any):
+    t = type(obj)
+
     if t in normal_types:
         return obj
     
@@ -22,12 +51,13 @@ def normalize(obj: any):
     
     # python objects
     try:
-        return {key: normalize(getattr(obj, key)) for key in vars(obj) if getattr(obj, key) is not None}
+        return {key: normalize(value) for key, value in vars(obj).items() if value is not None}
     except Exception as e:
         raise Exception(f"Cannot serialize object of type '{t}': {obj}, {e}")
 
 
-def denormalize(obj: any, Class: Callable[[], T]) -> T:
+def _denormalize(obj: any, Class: Callable[[], T]) -> T:
+    """Generic (uncompiled) denormalize, used as the fallback for anything a compiled decoder doesn't handle"""
     if Class is None or Class is Any or obj is None:
         return obj
 
@@ -96,6 +126,326 @@ def denormalize(obj: any, Class: Callable[[], T]) -> T:
     return Class(**kwargs)
 
 
+@dataclass(frozen=True)
+class Codec(Generic[T]):
+    """Encoder/decoder pair compiled for a single type by `codec_for`"""
+    encode: Callable[[T], any]
+    decode: Callable[[any], T]
+
+    def dumps(self, obj: T, **kwargs) -> str:
+        return json.dumps(self.encode(obj), **kwargs)
+
+    def loads(self, s: Union[str, bytes, bytearray], **kwargs) -> T:
+        return self.decode(json.loads(s, **kwargs))
+
+
+_codecs: Dict[any, Codec] = {}
+_codecs_lock = threading.RLock()
+
+
+def codec_for(Class: Callable[[], T]) -> Codec[T]:
+    """Returns the cached Codec for `Class`, compiling it on first use.
+
+    The type is walked once, and the resulting encode/decode closures dispatch
+    straight to the closures compiled for each nested type.
+    """
+    try:
+        return _codecs[Class]
+    except KeyError:
+        pass
+    except TypeError:
+        # Unhashable "type", can't be cached
+        return Codec(normalize, lambda obj: _denormalize(obj, Class))
+
+    with _codecs_lock:
+        pending: Dict[any, Codec] = {}
+        codec = _lookup(Class, pending)
+        _codecs.update(pending)
+        return codec
+
+
+def _lookup(Class, pending: Dict[any, Codec]) -> Codec:
+    try:
+        return _codecs[Class]
+    except KeyError:
+        pass
+    except TypeError:
+        return Codec(normalize, lambda obj: _denormalize(obj, Class))
+
+    if Class in pending:
+        return pending[Class]
+
+    return _compile(Class, pending)
+
+
+def _compile(Class, pending: Dict[any, Codec]) -> Codec:
+    if Class is None or Class is Any:
+        codec = Codec(normalize, lambda obj: obj)
+        pending[Class] = codec
+        return codec
+
+    def fallback(obj):
+        return _denormalize(obj, Class)
+
+    if Class is Interned:
+        def decode(obj):
+            return sys.intern(obj) if type(obj) is str else obj
+
+        codec = Codec(normalize, decode)
+        pending[Class] = codec
+        return codec
+
+    # Primitives and bare containers
+    if Class in normal_types or Class in (list, set, dict):
+        def encode(obj):
+            return obj if type(obj) in normal_types else normalize(obj)
+
+        if Class in (list, set, dict):
+            encode = _normalize
+
+        def decode(obj):
+            if obj is None or type(obj) is Class:
+                return obj
+            return fallback(obj)
+
+        if Class == float:
+            def decode(obj):
+                t = type(obj)
+                if obj is None or t is float:
+                    return obj
+                if t is int:
+                    return float(obj)
+                return fallback(obj)
+
+        codec = Codec(encode, decode)
+        pending[Class] = codec
+        return codec
+
+    # List and dict wrappers, e.g. the lazy child proxies of serialize.sqlite, are stored as what they wrap
+    if isinstance(Class, type) and issubclass(Class, (collections.UserList, collections.UserDict)):
+        codec = Codec(lambda obj: _normalize(obj.data), fallback)
+        pending[Class] = codec
+        return codec
+
+    origin = get_origin(Class)
+    type_args = get_args(Class)
+
+    if origin == Literal:
+        codec = Codec(normalize, lambda obj: obj)
+        pending[Class] = codec
+        return codec
+
+    if origin in (list, set):
+        item_codec = _lookup(type_args[0], pending) if len(type_args) > 0 else _lookup(Any, pending)
+        encode_item = item_codec.encode
+        decode_item = item_codec.decode
+        container = origin
+
+        def encode(obj):
+            if type(obj) is not list and type(obj) is not set:
+                return normalize(obj)
+            return [encode_item(item) for item in obj]
+
+        def decode(obj):
+            if type(obj) is not list:
+                return fallback(obj)
+            return container([decode_item(item) for item in obj])
+
+        codec = Codec(encode, decode)
+        pending[Class] = codec
+        return codec
+
+    if origin == dict:
+        if len(type_args) > 0 and type_args[0] not in (str, Interned):
+            # Let the generic path raise for unsupported key types
+            codec = Codec(normalize, fallback)
+            pending[Class] = codec
+            return codec
+
+        value_codec = _lookup(type_args[1], pending) if len(type_args) > 0 else _lookup(Any, pending)
+        encode_value = value_codec.encode
+        decode_value = value_codec.decode
+
+        def encode(obj):
+            if type(obj) is not dict:
+                return normalize(obj)
+            return {key: encode_value(value) for key, value in obj.items() if value is not None}
+
+        def decode(obj):
+            if type(obj) is not dict:
+                return fallback(obj)
+            return {key: decode_value(value) for key, value in obj.items()}
+
+        if len(type_args) > 0 and type_args[0] is Interned:
+            def decode(obj):
+                if type(obj) is not dict:
+                    return fallback(obj)
+                return {sys.intern(key): decode_value(value) for key, value in obj.items()}
+
+        codec = Codec(encode, decode)
+        pending[Class] = codec
+        return codec
+
+    if origin is not None:
+        # Union, Optional, Tuple, ... aren't compiled
+        codec = Codec(normalize, fallback)
+        pending[Class] = codec
+        return codec
+
+    # python objects
+    try:
+        type_hints = get_type_hints(Class)
+    except Exception:
+        codec = Codec(_normalize, fallback)
+        pending[Class] = codec
+        return codec
+    # Class attributes and init-only arguments aren't fields of the instances
+    type_hints = {var_name: type_hint for var_name, type_hint in type_hints.items()
+                  if not (get_origin(type_hint) is ClassVar or type_hint is ClassVar or isinstance(type_hint, InitVar) or type_hint is InitVar)}
+
+    # Filled in below, after this codec is registered, so that recursive types resolve to it
+    field_encoders: Dict[str, Callable] = {}
+    field_decoders: List[Tuple[str, Callable]] = []
+
+    # Instances of slotted dataclasses and named tuples (e.g. compact types) have no __dict__. Other
+    # objects without one, like tuples or UUIDs, can't be serialized.
+    has_slots = (is_dataclass(Class) and '__slots__' in vars(Class)) or (isinstance(Class, type) and issubclass(Class, tuple) and hasattr(Class, '_fields'))
+    field_names = list(type_hints.keys())
+
+    def encode(obj):
+        if type(obj) is not Class:
+            return normalize(obj)
+        try:
+            result = {}
+            items = ((key, getattr(obj, key, None)) for key in field_names) if has_slots else vars(obj).items()
+            for key, value in items:
+                if value is None:
+                    continue
+                if type(value) in normal_types:
+                    result[key] = value
+                else:
+                    result[key] = field_encoders.get(key, normalize)(value)
+            return result
+        except Exception as e:
+            raise Exception(f"Cannot serialize object of type '{Class}': {obj}, {e}")
+
+    def decode(obj):
+        if type(obj) is not dict:
+            return fallback(obj)
+        return Class(**{var_name: decode_field(obj[var_name]) for var_name, decode_field in field_decoders if var_name in obj})
+
+    codec = Codec(encode, decode)
+    pending[Class] = codec
+
+    for var_name, type_hint in type_hints.items():
+        field_codec = _lookup(type_hint, pending)
+        field_encoders[var_name] = field_codec.encode
+        field_decoders.append((var_name, field_codec.decode))
+
+    return codec
+
+
+compact_kinds = ['slots', 'tuple']
+
+_compact_types: Dict[Tuple[any, str, bool], type] = {}
+
+
+def compact_type(Class: Callable[[], T], kind: str='slots', intern_strings: bool=True) -> Callable[..., T]:
+    """Returns a memory-efficient class with the same fields as the dataclass `Class`, to decode into
+
+    Objects of the returned class have the same field access as `Class` objects, without a
+    per-instance `__dict__`. Dataclass fields are converted too, e.g. a `List[Address]` field
+    becomes a list of compact Address objects.
+
+    Args:
+        Class: A dataclass
+        kind (str, optional): 'slots' for a dataclass with `__slots__` (needs Python 3.10), or
+            'tuple' for an immutable named tuple. Named tuple fields with a default_factory
+            default to None. Defaults to 'slots'.
+        intern_strings (bool, optional): Intern the decoded str values and dict keys, so that
+            repeated strings are stored once. Defaults to True.
+    """
+    key = (Class, kind, intern_strings)
+    # None while another thread is building the type
+    CompactClass = _compact_types.get(key)
+    if CompactClass is not None:
+        return CompactClass
+
+    if kind not in compact_kinds:
+        raise Exception(f'Unknown compact type kind {kind}, expected one of {compact_kinds}')
+    if not is_dataclass(Class):
+        raise Exception(f'Compact types can only be made from dataclasses, not {Class}')
+    if kind == 'slots' and sys.version_info < (3, 10):
+        raise Exception('Slotted compact types need Python 3.10 or later')
+
+    with _codecs_lock:
+        if key in _compact_types:
+            return _compact_types[key]
+
+        type_hints = get_type_hints(Class)
+        # Marks the type while its fields are converted
+        _compact_types[key] = None
+        try:
+            # Only the dataclass fields, not ClassVar or InitVar annotations
+            field_types = {f.name: _compact_hint(type_hints[f.name], kind, intern_strings) for f in fields(Class)}
+        finally:
+            del _compact_types[key]
+
+        # Rebuilt from `Class` when unpickled, e.g. from a worker process
+        def __reduce__(self):
+            return _rebuild_compact, (Class, kind, intern_strings, tuple(getattr(self, var_name) for var_name in field_types))
+
+        if kind == 'slots':
+            specs = []
+            for f in fields(Class):
+                if f.name in field_types:
+                    specs.append((f.name, field_types[f.name], field(default=f.default, default_factory=f.default_factory, repr=f.repr, compare=f.compare)))
+            CompactClass = make_dataclass(Class.__name__, specs, namespace={'__reduce__': __reduce__}, slots=True)
+        else:
+            defaults = {f.name: None if f.default is MISSING else f.default for f in fields(Class) if f.default is not MISSING or f.default_factory is not MISSING}
+            field_names = list(field_types.keys())
+            first_default = next((index for index, var_name in enumerate(field_names) if var_name in defaults), len(field_names))
+            CompactClass = collections.namedtuple(Class.__name__, field_names, defaults=[defaults[var_name] for var_name in field_names[first_default:]])
+            CompactClass.__annotations__ = field_types
+            CompactClass.__reduce__ = __reduce__
+
+        CompactClass.__module__ = Class.__module__
+        CompactClass.__qualname__ = f'{Class.__qualname__}.<compact {kind}>'
+        _compact_types[key] = CompactClass
+        return CompactClass
+
+
+def _rebuild_compact(Class, kind: str, intern_strings: bool, values: tuple):
+    return compact_type(Class, kind, intern_strings)(*values)
+
+
+def _compact_hint(type_hint, kind: str, intern_strings: bool):
+    """Returns `type_hint` with its dataclasses replaced by their compact types, and str by Interned when interning"""
+    if type_hint is str:
+        return Interned if intern_strings else str
+
+    if is_dataclass(type_hint):
+        key = (type_hint, kind, intern_strings)
+        if key in _compact_types and _compact_types[key] is None:
+            raise Exception(f'Compact types of recursive types are not supported: {type_hint}')
+        return compact_type(type_hint, kind, intern_strings)
+
+    origin = get_origin(type_hint)
+    type_args = get_args(type_hint)
+    if len(type_args) == 0:
+        return type_hint
+
+    args = tuple(_compact_hint(type_arg, kind, intern_strings) for type_arg in type_args)
+    if origin in (list, set):
+        return {list: List, set: Set}[origin][args[0]]
+    if origin == dict:
+        return Dict[args[0], args[1]]
+    if origin == Union:
+        return Union[args]
+
+    return type_hint
+
+
 def dumps(obj: any, **kwargs):
     return json.dumps(normalize(obj), **kwargs)
 
@@ -105,27 +455,224 @@ def dump(obj: any, fp, **kwargs):
 
 
 def loads(s: Union[str, bytes, bytearray], Class: Callable[[], T], **kwargs) -> T:
-    return denormalize(json.loads(s, **kwargs), Class)
+    return codec_for(Class).loads(s, **kwargs)
 
 
 def load(fp, Class: Callable[[], T], **kwargs) -> T:
-    return denormalize(json.load(fp, **kwargs), Class)
+    return codec_for(Class).decode(json.load(fp, **kwargs))
+
+
+def dump_iter(objs: Iterable, fp, **kwargs) -> int:
+    """Writes `objs` to `fp` as JSON Lines, one object per line, returning the number written"""
+    count = 0
+    for obj in objs:
+        fp.write(json.dumps(normalize(obj), **kwargs))
+        fp.write('\n')
+        count += 1
+    return count
+
+
+# Characters that can continue a JSON number
+number_chars = '0123456789.eE+-'
+
+
+class _StreamDecoder:
+    """Decodes consecutive JSON values from a file, reading it `buffer_size` characters at a time"""
+
+    def __init__(self, fp, buffer_size: int, **kwargs):
+        self.fp = fp
+        self.buffer_size = buffer_size
+        self.decoder = json.JSONDecoder(**kwargs)
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def read(self) -> bool:
+        """Appends the next chunk of the file to the buffer, returning False at the end of the file"""
+        if self.eof:
+            return False
+
+        chunk = self.fp.read(self.buffer_size)
+        if isinstance(chunk, bytes):
+            chunk = self.text_decoder.decode(chunk, final=len(chunk) == 0)
+
+        if len(chunk) == 0:
+            self.eof = True
+            return False
+
+        # Drop what's already been decoded
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> Optional[str]:
+        """Skips whitespace, returning the next character or None at the end of the file"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read():
+                return None
+
+    def expect(self, char: str):
+        if self.peek() != char:
+            raise json.JSONDecodeError(f'Expecting {char!r}', self.buffer, self.pos)
+        self.pos += 1
+
+    def decode(self) -> any:
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.read():
+                    continue
+                raise
+
+            # A number cut off by the end of the buffer, e.g. '2.' or '1e' of '2.5' or '1e5', decodes to
+            # its prefix, so read on until something other than number characters follows it
+            if type(obj) in (int, float) and self.buffer[end:].strip(number_chars) == '' and self.read():
+                continue
+
+            self.pos = end
+            return obj
+
+
+def load_iter(fp, Class: Callable[[], T], buffer_size: int=65536, **kwargs) -> Iterator[T]:
+    """Yields the objects in a JSON Lines file one at a time, decoded to `Class`
+
+    Only the current chunk of the file is held in memory.
+    """
+    decode = codec_for(Class).decode
+    stream = _StreamDecoder(fp, buffer_size, **kwargs)
+    while stream.peek() is not None:
+        yield decode(stream.decode())
+
+
+def load_array_iter(fp, Class: Callable[[], T], buffer_size: int=65536, **kwargs) -> Iterator[T]:
+    """Yields the items of a file containing one JSON array (e.g. written by `dump` from a List[Class]) one at a time"""
+    decode = codec_for(Class).decode
+    stream = _StreamDecoder(fp, buffer_size, **kwargs)
+    stream.expect('[')
+    if stream.peek() == ']':
+        return
+
+    while True:
+        yield decode(stream.decode())
+        if stream.peek() == ']':
+            return
+        stream.expect(',')
+
+
+def write_atomic(filename: str, text: str):
+    """Writes `text` to a temporary file next to `filename`, fsyncs it, and renames it over `filename`
+
+    A crash leaves either the old or the new file, never a truncated one.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp_filename = tempfile.mkstemp(dir=directory, prefix=os.path.basename(filename) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(text)
+            fp.flush()
+            os.fsync(fp.fileno())
+
+        if os.path.exists(filename):
+            shutil.copymode(filename, temp_filename)
+
+        os.replace(temp_filename, filename)
+    except BaseException:
+        try:
+            os.remove(temp_filename)
+        except OSError:
+            pass
+        raise
+
+
+# JSONFiles with a background save scheduled, saved at exit if it hasn't run yet
+_pending_files: 'weakref.WeakSet[JSONFile]' = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_pending_files():
+    for json_file in list(_pending_files):
+        json_file.flush_logged()
 
 
 class JSONFile(Generic[T]):
+    """`contents` loaded from, and saved to, a JSON file
+
+    `save` skips writing when the contents serialize to the same JSON as last saved, and
+    writes atomically. With `save_delay` set, `save` only schedules a background save after
+    that many seconds, so saves in between are coalesced. Call `flush` (or `close`, or use
+    the JSONFile as a context manager) to write pending changes immediately. Pending changes
+    are also written at interpreter exit.
+    """
     filename: str
     contents: T
+    save_delay: Optional[float]
 
-    def __init__(self, filename: str, Class: Callable[[], T]):
+    def __init__(self, filename: str, Class: Callable[[], T], save_delay: Optional[float]=None):
         self.filename = filename
+        self.save_delay = save_delay
+        self.saved_digest: Optional[bytes] = None
+        self.lock = threading.RLock()
+        self.timer: Optional[threading.Timer] = None
         
         try:
-            self.contents = load(open(filename, 'r'), Class)
+            with open(filename, 'r') as fp:
+                text = fp.read()
+            self.contents = loads(text, Class)
+            self.saved_digest = hashlib.blake2b(text.encode()).digest()
         except (FileNotFoundError, json.JSONDecodeError) as e:
             self.contents = Class()
 
-    def save(self):
-        dump(self.contents, open(self.filename, 'w'))
+    def save(self, force: bool=False):
+        if self.save_delay is None or force:
+            self.flush(force)
+            return
+
+        with self.lock:
+            if self.timer is None:
+                self.timer = threading.Timer(self.save_delay, self.flush_logged)
+                self.timer.daemon = True
+                self.timer.start()
+                _pending_files.add(self)
+
+    def flush(self, force: bool=False) -> bool:
+        """Writes the contents now if they changed (or `force`), returning whether the file was written"""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+                _pending_files.discard(self)
+
+            text = dumps(self.contents)
+            digest = hashlib.blake2b(text.encode()).digest()
+            if digest == self.saved_digest and not force:
+                return False
+
+            write_atomic(self.filename, text)
+            self.saved_digest = digest
+            return True
+
+    def flush_logged(self):
+        """Runs `flush` in the background, where there's no caller to raise to"""
+        try:
+            self.flush()
+        except Exception:
+            l.exception(f'Failed to save {self.filename}')
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self) -> 'JSONFile[T]':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
 
 def main():
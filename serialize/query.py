@@ -0,0 +1,126 @@
+from dataclasses import *
+from typing import *
+import abc
+
+
+class Predicate(abc.ABC):
+    """A condition on the stored objects, compiled to parameterized SQL by the Database"""
+
+    def __and__(self, other: 'Predicate') -> 'Predicate':
+        return and_(self, other)
+
+    def __or__(self, other: 'Predicate') -> 'Predicate':
+        return or_(self, other)
+
+    def __invert__(self) -> 'Predicate':
+        return not_(self)
+
+    @abc.abstractmethod
+    def to_sql(self, condition_sql: Callable[[str, str], str]) -> Tuple[str, List[any]]:
+        """Returns the SQL expression and its parameters
+
+        Args:
+            condition_sql (Callable[[str, str], str]): Given a key path and a condition on its value
+                (e.g. '< ?'), returns SQL that is true for the objects rows satisfying it
+        """
+
+
+@dataclass(frozen=True)
+class Condition(Predicate):
+    key_path: str
+    condition: str
+    parameters: Tuple = ()
+
+    def to_sql(self, condition_sql: Callable[[str, str], str]) -> Tuple[str, List[any]]:
+        return condition_sql(self.key_path, self.condition), list(self.parameters)
+
+
+@dataclass(frozen=True)
+class And(Predicate):
+    predicates: Tuple[Predicate, ...]
+
+    def to_sql(self, condition_sql: Callable[[str, str], str]) -> Tuple[str, List[any]]:
+        return join_sql(' and ', self.predicates, condition_sql)
+
+
+@dataclass(frozen=True)
+class Or(Predicate):
+    predicates: Tuple[Predicate, ...]
+
+    def to_sql(self, condition_sql: Callable[[str, str], str]) -> Tuple[str, List[any]]:
+        return join_sql(' or ', self.predicates, condition_sql)
+
+
+@dataclass(frozen=True)
+class Not(Predicate):
+    predicate: Predicate
+
+    def to_sql(self, condition_sql: Callable[[str, str], str]) -> Tuple[str, List[any]]:
+        sql, parameters = self.predicate.to_sql(condition_sql)
+        return f'not ({sql})', parameters
+
+
+def join_sql(operator: str, predicates: Iterable[Predicate], condition_sql: Callable[[str, str], str]) -> Tuple[str, List[any]]:
+    sql_list: List[str] = []
+    parameters: List[any] = []
+    for predicate in predicates:
+        sql, predicate_parameters = predicate.to_sql(condition_sql)
+        sql_list.append(sql)
+        parameters.extend(predicate_parameters)
+
+    return '(' + operator.join(sql_list) + ')', parameters
+
+
+def eq(key_path: str, value: any) -> Predicate:
+    return Condition(key_path, '= ?', (value,))
+
+
+def ne(key_path: str, value: any) -> Predicate:
+    return Condition(key_path, '!= ?', (value,))
+
+
+def lt(key_path: str, value: any) -> Predicate:
+    return Condition(key_path, '< ?', (value,))
+
+
+def le(key_path: str, value: any) -> Predicate:
+    return Condition(key_path, '<= ?', (value,))
+
+
+def gt(key_path: str, value: any) -> Predicate:
+    return Condition(key_path, '> ?', (value,))
+
+
+def ge(key_path: str, value: any) -> Predicate:
+    return Condition(key_path, '>= ?', (value,))
+
+
+def between(key_path: str, low: any, high: any) -> Predicate:
+    return Condition(key_path, 'between ? and ?', (low, high))
+
+
+def in_(key_path: str, values: Iterable[any]) -> Predicate:
+    values = tuple(values)
+    placeholders = ', '.join(['?'] * len(values))
+    return Condition(key_path, f'in ({placeholders})', values)
+
+
+def like(key_path: str, pattern: str) -> Predicate:
+    return Condition(key_path, 'like ?', (pattern,))
+
+
+def sql(key_path: str, conditional: str) -> Predicate:
+    """Raw SQL condition on the value at `key_path`, e.g. sql('age', '> 30')"""
+    return Condition(key_path, conditional)
+
+
+def and_(*predicates: Predicate) -> Predicate:
+    return And(tuple(predicates))
+
+
+def or_(*predicates: Predicate) -> Predicate:
+    return Or(tuple(predicates))
+
+
+def not_(predicate: Predicate) -> Predicate:
+    return Not(predicate)
@@ -0,0 +1,405 @@
+import concurrent.futures
+import heapq
+import os
+import queue
+import threading
+import zlib
+from serialize import query
+from serialize.database import Database, batches, get_values, metadata_table
+from typing import *
+
+T = TypeVar("T")
+
+
+def shard_filenames(filename: str, shard_count: int) -> List[str]:
+    """Returns the shard files of `filename`, e.g. data.0.db, data.1.db, ... for data.db"""
+    root, extension = os.path.splitext(filename)
+    return [f'{root}.{shard}{extension}' for shard in range(shard_count)]
+
+
+def sql_rank(value: any) -> int:
+    # SQLite orders nulls first, then numbers, text and blobs
+    if value is None:
+        return 0
+    if isinstance(value, (int, float)):
+        return 1
+    if isinstance(value, str):
+        return 2
+    return 3
+
+
+class OrderKey:
+    """Sort key of a row ordered by several key paths, each ascending or descending, compared the way SQLite orders them"""
+    __slots__ = ('values', 'descending')
+
+    def __init__(self, values: List[any], descending: List[bool]):
+        self.values = values
+        self.descending = descending
+
+    def __eq__(self, other: 'OrderKey') -> bool:
+        return self.values == other.values
+
+    def __lt__(self, other: 'OrderKey') -> bool:
+        for value, other_value, descending in zip(self.values, other.values, self.descending):
+            if value == other_value:
+                continue
+
+            rank, other_rank = sql_rank(value), sql_rank(other_value)
+            less = rank < other_rank if rank != other_rank else value < other_value
+            return not less if descending else less
+        return False
+
+
+def threaded(make_iterator: Callable[[], Iterator], chunk_size: int, stop: threading.Event) -> Iterator:
+    """Runs `make_iterator()` on its own thread, yielding its items as they're produced, `chunk_size` at a time
+
+    The thread stops early once `stop` is set.
+    """
+    chunks: queue.Queue = queue.Queue(maxsize=2)
+
+    def put(item: any) -> bool:
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            iterator = make_iterator()
+            try:
+                for chunk in batches(iterator, chunk_size):
+                    if not put(chunk):
+                        return
+            finally:
+                if hasattr(iterator, 'close'):
+                    iterator.close()
+            put(None)
+        except BaseException as e:
+            put(e)
+
+    threading.Thread(target=produce, name='ShardedDatabase-scan', daemon=True).start()
+
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            return
+        if isinstance(chunk, BaseException):
+            raise chunk
+        yield from chunk
+
+
+class ShardedDatabase(Generic[T]):
+    """Objects partitioned across several Database files
+
+    Objects are spread evenly across the shards, or by the hash of their value at `shard_key`,
+    so objects with the same value are in the same shard. Writes to each shard go through its own
+    connection and write lock, on its own thread. Queries run on all shards in parallel threads,
+    and their results are merged into the same order a single Database would return, or on just
+    one shard when they test `shard_key` for equality.
+
+    Ids are unique across shards: the object with id `local_id` in shard `shard` has id
+    `local_id * shard_count + shard`. Writes to several shards aren't in one transaction, and the
+    number of shards can't change once objects are stored.
+    """
+    datatype: Callable[..., T]
+    shards: List[Database[T]]
+
+    def __init__(self, datatype: Callable[..., T], filename: str='data.db', shard_count: int=4, shard_key: Optional[str]=None,
+                 filenames: Optional[List[str]]=None, **kwargs):
+        """
+        Args:
+            datatype: Type of the stored objects
+            filename (str, optional): Base name of the shard files, which are named data.0.db, data.1.db, ... for
+                'data.db'. Defaults to 'data.db'.
+            shard_count (int, optional): Number of shards. Defaults to 4.
+            shard_key (str, optional): Key path with a single value per object to partition by. Defaults to spreading
+                objects evenly.
+            filenames (List[str], optional): Shard files, e.g. on different disks, instead of naming them after `filename`
+            **kwargs: Passed on to each shard's Database. `pool_size` must be at least 1, and defaults to 4.
+        """
+        if filenames is None:
+            filenames = shard_filenames(filename, shard_count)
+        if len(filenames) == 0:
+            raise Exception('A ShardedDatabase needs at least one shard')
+
+        # Shards are used from several threads
+        kwargs.setdefault('pool_size', 4)
+        if kwargs['pool_size'] < 1:
+            raise Exception(f'ShardedDatabase needs pooled shards, got pool_size {kwargs["pool_size"]}')
+
+        self.datatype = datatype
+        self.shard_key = shard_key
+        self.shards = [Database(datatype, shard_filename, **kwargs) for shard_filename in filenames]
+        self.executors = [concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'ShardedDatabase-{shard}') for shard in range(len(self.shards))]
+        try:
+            for shard, database in enumerate(self.shards):
+                self.check_layout(shard, database)
+        except BaseException:
+            self.close()
+            raise
+
+        # Next shard to insert into when there's no shard_key
+        self.next_shard = 0
+        self.next_shard_lock = threading.Lock()
+
+
+    def check_layout(self, shard: int, database: Database[T]):
+        """Records the shard's place in the layout in its metadata table, or raises if it was written with another layout
+
+        Ids and shard keys map to shards by the number of shards, so opening the files with a different
+        number of shards, shard key or file order would lose objects or return the wrong ones.
+        """
+        layout = {'shard': str(shard), 'shard_count': str(self.shard_count), 'shard_key': self.shard_key or ''}
+        with database.write_lock:
+            recorded = dict(database.conn.execute(f"select key, value from {metadata_table} where key in ('shard', 'shard_count', 'shard_key')").fetchall())
+            if len(recorded) == 0:
+                if database.conn.execute('select 1 from objects limit 1').fetchone() is not None:
+                    raise Exception(f'Database {database.filename} has objects but no shard layout, it is not a shard')
+                database.conn.executemany(f'insert into {metadata_table} (key, value) values (?, ?)', layout.items())
+                database.conn.commit()
+                return
+
+        if recorded != layout:
+            raise Exception(f'Database {database.filename} was written as shard {recorded.get("shard")} of {recorded.get("shard_count")} with shard key {recorded.get("shard_key") or None}, '
+                            f'not shard {shard} of {self.shard_count} with shard key {self.shard_key}')
+
+
+    @property
+    def shard_count(self) -> int:
+        return len(self.shards)
+
+
+    def global_id(self, shard: int, local_id: int) -> int:
+        return local_id * self.shard_count + shard
+
+
+    def local_id(self, id: int) -> Tuple[int, int]:
+        """Returns the shard of `id` and its id in that shard"""
+        return id % self.shard_count, id // self.shard_count
+
+
+    def shard_for_value(self, value: any) -> int:
+        return zlib.crc32(repr(value).encode()) % self.shard_count
+
+
+    def shard_for_item(self, item: T) -> int:
+        if self.shard_key is None:
+            with self.next_shard_lock:
+                shard = self.next_shard
+                self.next_shard = (shard + 1) % self.shard_count
+            return shard
+
+        values = get_values(item, self.shard_key)
+        if values is None or len(values) != 1:
+            raise Exception(f'Sharding needs a single value at {self.shard_key}, got {values}')
+        return self.shard_for_value(list(values)[0])
+
+
+    def shards_for(self, where: Union[str, query.Predicate, None]) -> List[int]:
+        """Returns the shards that can hold objects matching `where`"""
+        if isinstance(where, query.Condition) and where.key_path == self.shard_key and where.condition == '= ?':
+            return [self.shard_for_value(where.parameters[0])]
+        return list(range(self.shard_count))
+
+
+    def scatter(self, function: Callable[[int, Database[T]], any], shards: Optional[List[int]]=None) -> List[any]:
+        """Runs `function(shard, database)` on each of `shards` in parallel, returning the results in shard order"""
+        if shards is None:
+            shards = list(range(self.shard_count))
+
+        futures = [self.executors[shard].submit(function, shard, self.shards[shard]) for shard in shards]
+        return [future.result() for future in futures]
+
+
+    def insert(self, new_item: T) -> int:
+        return self.insert_many([new_item])[0]
+
+
+    def insert_many(self, new_items: Iterable[T], batch_size: int=1000) -> List[int]:
+        """Inserts `new_items`, each shard's share in one transaction, returning the assigned ids in order"""
+        positions: List[List[int]] = [[] for shard in range(self.shard_count)]
+        shard_items: List[List[T]] = [[] for shard in range(self.shard_count)]
+        for position, item in enumerate(new_items):
+            shard = self.shard_for_item(item)
+            positions[shard].append(position)
+            shard_items[shard].append(item)
+
+        shards = [shard for shard in range(self.shard_count) if len(shard_items[shard]) > 0]
+        results = self.scatter(lambda shard, database: database.insert_many(shard_items[shard], batch_size), shards)
+
+        ids: List[int] = [0] * sum(len(items) for items in shard_items)
+        for shard, local_ids in zip(shards, results):
+            for position, local_id in zip(positions[shard], local_ids):
+                ids[position] = self.global_id(shard, local_id)
+        return ids
+
+
+    def update(self, id: int, new_item: T):
+        self.update_many([(id, new_item)])
+
+
+    def update_many(self, items: Iterable[Tuple[int, T]], batch_size: int=1000):
+        """Replaces the objects with the given ids, each shard's share in one transaction
+
+        With a `shard_key`, an update can't change the shard an object belongs in.
+        """
+        shard_items: List[List[Tuple[int, T]]] = [[] for shard in range(self.shard_count)]
+        for id, new_item in items:
+            shard, local_id = self.local_id(id)
+            if self.shard_key is not None and self.shard_for_item(new_item) != shard:
+                raise Exception(f'Cannot update object {id} to a {self.shard_key} in another shard')
+            shard_items[shard].append((local_id, new_item))
+
+        shards = [shard for shard in range(self.shard_count) if len(shard_items[shard]) > 0]
+        self.scatter(lambda shard, database: database.update_many(shard_items[shard], batch_size), shards)
+
+
+    def upsert(self, key_path: str, new_item: T) -> int:
+        """Updates the object with the same value at `key_path` as `new_item`, or inserts `new_item` if there isn't one
+
+        Unless `key_path` is the `shard_key`, every shard is searched, and concurrent upserts of the
+        same value may both insert.
+
+        Returns:
+            int: The id of the updated or inserted object
+        """
+        if key_path == self.shard_key:
+            shard = self.shard_for_item(new_item)
+            return self.global_id(shard, self.scatter(lambda shard, database: database.upsert(key_path, new_item), [shard])[0])
+
+        values = get_values(new_item, key_path)
+        if values is None or len(values) != 1:
+            raise Exception(f'Upsert needs a single value at {key_path}, got {values}')
+
+        ids = list(self.select_ids(query.eq(key_path, list(values)[0]), limit=2))
+        if len(ids) > 1:
+            raise Exception(f'Upsert found {len(ids)} objects with the same {key_path}')
+
+        if len(ids) == 1:
+            self.update(ids[0], new_item)
+            return ids[0]
+        return self.insert(new_item)
+
+
+    def get(self, id: int) -> Optional[T]:
+        """Returns the object with `id`, or None if there isn't one"""
+        shard, local_id = self.local_id(id)
+        return self.shards[shard].get(local_id)
+
+
+    def create_index(self, key_path: str, **kwargs):
+        """Creates the index on `key_path` in every shard, in parallel. `kwargs` are passed on to Database.create_index."""
+        self.scatter(lambda shard, database: database.create_index(key_path, **kwargs))
+
+
+    def delete(self, where: Union[str, query.Predicate], conditional: Optional[str]=None):
+        self.scatter(lambda shard, database: database.delete(where, conditional), self.shards_for(where))
+
+
+    def _gather(self, shards: List[int], make_iterator: Callable[[Database[T], Optional[int]], Iterator[Tuple[int, any]]], after_id: Optional[int], limit: Optional[int],
+                batch_size: int, sort_key: Optional[Callable[[Tuple[int, any]], OrderKey]]) -> Iterator[Tuple[int, any]]:
+        """Merges the (local id, result) pairs of `make_iterator(database, local_after_id)` on each of `shards`,
+        run in parallel threads, into (global id, result) pairs ordered by `sort_key` then id
+        """
+        def shard_results(shard: int) -> Iterator[Tuple[int, any]]:
+            # Global ids after `after_id` are the shard's local ids after (after_id - shard) // shard_count
+            local_after_id = None if after_id is None else (after_id - shard) // self.shard_count
+            database = self.shards[shard]
+            for local_id, result in threaded(lambda: make_iterator(database, local_after_id), batch_size, stop):
+                yield self.global_id(shard, local_id), result
+
+        stop = threading.Event()
+        try:
+            streams = [shard_results(shard) for shard in shards]
+            if sort_key is None:
+                merged = heapq.merge(*streams, key=lambda row: row[0])
+            else:
+                merged = heapq.merge(*streams, key=lambda row: (sort_key(row), row[0]))
+
+            for count, row in enumerate(merged):
+                if limit is not None and count >= limit:
+                    return
+                yield row
+        finally:
+            stop.set()
+
+
+    def order_key(self, order_by: Union[str, List[str], None]) -> Tuple[List[str], List[bool]]:
+        """Returns the key paths of `order_by` and whether each is descending"""
+        if order_by is None:
+            return [], []
+        if isinstance(order_by, str):
+            order_by = [order_by]
+        return [key_path.lstrip('-') for key_path in order_by], [key_path.startswith('-') for key_path in order_by]
+
+
+    def select(self, where: Union[str, query.Predicate, None]=None, conditional: Optional[str]=None, after_id: Optional[int]=None, limit: Optional[int]=None, order_by: Union[str, List[str], None]=None,
+               batch_size: int=1000, with_ids: bool=False, raw: bool=False, fields: Optional[List[str]]=None) -> Iterator:
+        """Yields the objects matching `where` in all shards, taking the same arguments as Database.select
+
+        Each shard is queried on its own thread, with `limit` applied per shard and again to the merged results.
+        Results are in id order, or ordered by `order_by`, which with `raw` must be None.
+        """
+        key_paths, descending = self.order_key(order_by)
+        ordered = len(key_paths) > 0 and key_paths != ['id']
+        if ordered and raw:
+            raise Exception('Cannot merge raw results ordered by key paths')
+
+        if key_paths == ['id'] and descending[0]:
+            raise Exception('ShardedDatabase can only order by id ascending')
+        if ordered and after_id is not None:
+            raise Exception('after_id pages through results in id order, it cannot be combined with order_by')
+
+        # Select the order by key paths too, to merge by them
+        projected = fields
+        if ordered and fields is not None:
+            projected = fields + [key_path for key_path in key_paths if key_path not in fields and key_path != 'id']
+
+        def order_value(row: Tuple[int, any], key_path: str) -> any:
+            if key_path == 'id':
+                return row[0]
+            if fields is not None:
+                return row[1][key_path]
+            return next(iter(get_values(row[1], key_path) or [None]))
+
+        sort_key = None
+        if ordered:
+            sort_key = lambda row: OrderKey([order_value(row, key_path) for key_path in key_paths], descending)
+
+        def make_iterator(database: Database[T], local_after_id: Optional[int]) -> Iterator:
+            return database.select(where, conditional, local_after_id, limit, order_by, batch_size, with_ids=True, raw=raw, fields=projected)
+
+        for id, result in self._gather(self.shards_for(where), make_iterator, after_id, limit, batch_size, sort_key):
+            if projected is not fields:
+                result = {key_path: result[key_path] for key_path in fields}
+            yield (id, result) if with_ids else result
+
+
+    def select_ids(self, where: Union[str, query.Predicate, None]=None, conditional: Optional[str]=None, after_id: Optional[int]=None, limit: Optional[int]=None, order_by: Union[str, List[str], None]=None,
+                   batch_size: int=1000) -> Iterator[int]:
+        key_paths, descending = self.order_key(order_by)
+        fields = [key_path for key_path in key_paths if key_path != 'id']
+        for id, values in self.select(where, conditional, after_id, limit, order_by, batch_size, with_ids=True, fields=fields):
+            yield id
+
+
+    def iterate(self, after_id: Optional[int]=None, limit: Optional[int]=None, batch_size: int=1000, with_ids: bool=False, raw: bool=False) -> Iterator:
+        return self.select(after_id=after_id, limit=limit, batch_size=batch_size, with_ids=with_ids, raw=raw)
+
+
+    def fetchall(self) -> List[T]:
+        return list(self.select())
+
+
+    def fetchall_with_ids(self) -> List[Tuple[int, T]]:
+        return list(self.select(with_ids=True))
+
+
+    def close(self):
+        for executor in self.executors:
+            executor.shutdown()
+        for database in self.shards:
+            database.close()
@@ -2,9 +2,13 @@
 
 from dataclasses import *
 from typing import *
+import array
+import collections
 import sqlite3
 import os
-import copy
+import itertools
+import sys
+from serialize import instrument
 
 T = TypeVar("T")
 
@@ -22,6 +26,179 @@ sqlite_to_python_type_map = {
     'real': 'float'
 }
 
+# array typecodes of the list item types that can be packed
+packed_typecodes = {
+    int: 'q',
+    float: 'd'
+}
+
+
+def packed_field(view: bool=False, **kwargs):
+    """A dataclass field for a List[int] or List[float] stored packed into one BLOB column of its
+    object's table, rather than as a row per element in a child table
+
+    Args:
+        view (bool, optional): Read the list as a read-only memoryview of the BLOB, without copying it,
+            instead of as a list. Objects read this way compare unequal to the objects that were stored,
+            and can't be serialized with `serialize.json` until the view is converted with `tolist()`.
+            Defaults to False.
+        **kwargs: Passed on to dataclasses.field
+    """
+    metadata = dict(kwargs.pop('metadata', None) or {})
+    metadata['sqlite_packed'] = 'view' if view else 'list'
+    return field(metadata=metadata, **kwargs)
+
+
+def pack(typecode: str, values: Optional[Iterable]) -> Optional[bytes]:
+    """Packs `values` into little-endian machine values of the array `typecode`"""
+    if values is None:
+        return None
+    packed = array.array(typecode, values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack(typecode: str, data: Optional[bytes], view: bool) -> Union[List, memoryview, None]:
+    if data is None:
+        return None
+
+    if sys.byteorder == 'big':
+        values = array.array(typecode)
+        values.frombytes(data)
+        values.byteswap()
+        return memoryview(values) if view else values.tolist()
+
+    values = memoryview(data).cast(typecode)
+    return values if view else values.tolist()
+
+
+def get_container_levels(Type, index_number: int) -> Tuple[List[Tuple[type, str]], any]:
+    """Returns the (container type, key column name) of each list/dict level of `Type`, and the item type inside them
+
+    Args:
+        Type: The type stored in a table
+        index_number (int): Number of parent key columns the table has before the first level's key column
+    """
+    levels: List[Tuple[type, str]] = []
+
+    while True:
+        OriginType = get_origin(Type)
+        if OriginType == list:
+            levels.append((list, 'index' + str(index_number)))
+            Type = get_args(Type)[0]
+        elif OriginType == dict:
+            levels.append((dict, 'key' + str(index_number)))
+            Type = get_args(Type)[1]
+        else:
+            return levels, Type
+        index_number += 1
+
+
+@dataclass
+class TablePlan:
+    """The resolved layout of the table storing `Type` as `table_name`, shared by everything reading or writing it"""
+    table_name: str
+    Type: any
+    table_id: str
+    # list/dict levels of Type, when stored as the child table of an object
+    levels: List[Tuple[type, str]]
+    ItemType: any
+    type_hints: Dict[str, any]
+    scalar_columns: List[str]
+    # (var_name, type_hint, child_table_name) of the fields stored in child tables
+    child_fields: List[Tuple[str, any, str]]
+    # (var_name, typecode, view) of the packed_field fields, stored in BLOB columns after the scalar columns
+    packed_fields: List[Tuple[str, str, bool]] = field(default_factory=list)
+    sql: Dict[any, str] = field(default_factory=dict)
+
+    def __post_init__(self):
+        # The object's columns in its table, other than its id and parent keys
+        self.columns: List[str] = self.scalar_columns + [var_name for var_name, typecode, view in self.packed_fields]
+
+    def column_values(self, obj: any) -> List[any]:
+        values = [getattr(obj, var_name) for var_name in self.scalar_columns]
+        for var_name, typecode, view in self.packed_fields:
+            values.append(pack(typecode, getattr(obj, var_name)))
+        return values
+
+    def column_kwargs(self, values: Sequence[any]) -> Dict[str, any]:
+        """Returns the constructor arguments for the values of `columns`"""
+        kwargs = dict(zip(self.scalar_columns, values))
+        for (var_name, typecode, view), value in zip(self.packed_fields, values[len(self.scalar_columns):]):
+            kwargs[var_name] = unpack(typecode, value, view)
+        return kwargs
+
+    def insert_sql(self, column_names: Tuple[str, ...]) -> str:
+        key = ('insert', column_names)
+        if key not in self.sql:
+            column_names_string = ', '.join(column_names)
+            value_placeholders_string = ', '.join(['?'] * len(column_names))
+            self.sql[key] = f'insert into {self.table_name} ({column_names_string}) values ({value_placeholders_string})'
+        return self.sql[key]
+
+    def children_sql(self, parent_key_column: str, parent_id_count: int) -> str:
+        """Select for the rows of `parent_id_count` parents, in the order their containers are rebuilt in"""
+        key = ('children', parent_key_column, parent_id_count)
+        if key not in self.sql:
+            level_column_names = [column_name for container_type, column_name in self.levels]
+            if self.ItemType in type_map:
+                value_column_names = ['value']
+            else:
+                value_column_names = [self.table_id] + self.columns
+            columns_string = ', '.join([parent_key_column] + level_column_names + value_column_names)
+            order_string = ', '.join([parent_key_column] + level_column_names)
+            placeholders = ', '.join(['?'] * parent_id_count)
+            self.sql[key] = f'select {columns_string} from {self.table_name} where {parent_key_column} in ({placeholders}) order by {order_string}'
+        return self.sql[key]
+
+    def select_sql(self, column_names: Tuple[str, ...], parent_key_columns: Tuple[str, ...]=()) -> str:
+        key = ('select', column_names, parent_key_columns)
+        if key not in self.sql:
+            column_names_string = ', '.join(column_names)
+            if len(parent_key_columns) > 0:
+                conditional_string = ' where ' + ' and '.join([f'{key} is ?' for key in parent_key_columns])
+            else:
+                conditional_string = ''
+            self.sql[key] = f'select {column_names_string} from {self.table_name}{conditional_string}'
+        return self.sql[key]
+
+
+table_plans: Dict[Tuple[str, any], TablePlan] = {}
+
+
+def get_table_plan(table_name: str, Type) -> TablePlan:
+    """Returns the cached TablePlan for storing `Type` in `table_name`, creating it on first use"""
+    key = (table_name, Type)
+    plan = table_plans.get(key)
+    if plan is not None:
+        return plan
+
+    levels, ItemType = get_container_levels(Type, 1)
+
+    type_hints: Dict[str, any] = {}
+    scalar_columns: List[str] = []
+    child_fields: List[Tuple[str, any, str]] = []
+    packed_fields: List[Tuple[str, str, bool]] = []
+    if ItemType not in type_map and get_origin(ItemType) is None:
+        type_hints = get_type_hints(ItemType)
+        field_metadata = {f.name: f.metadata for f in fields(ItemType)} if is_dataclass(ItemType) else {}
+        for var_name, type_hint in type_hints.items():
+            packed = field_metadata.get(var_name, {}).get('sqlite_packed')
+            if packed is not None:
+                item_types = get_args(type_hint)
+                if get_origin(type_hint) != list or item_types[0] not in packed_typecodes:
+                    raise Exception(f'Error!  Only lists of {list(packed_typecodes.keys())} can be packed, not {var_name}: {type_hint}')
+                packed_fields.append((var_name, packed_typecodes[item_types[0]], packed == 'view'))
+            elif type_hint in type_map:
+                scalar_columns.append(var_name)
+            else:
+                child_fields.append((var_name, type_hint, table_name + '$' + var_name))
+
+    plan = TablePlan(table_name, Type, f'{table_name}_id', levels, ItemType, type_hints, scalar_columns, child_fields, packed_fields)
+    table_plans[key] = plan
+    return plan
+
 
 def create_table(cursor: sqlite3.Cursor, table_name: str, column_names: List[str]):
     columns_string = ', '.join(column_names)
@@ -62,12 +239,14 @@ def create_type_table(cursor: sqlite3.Cursor, table_name: str, Type, parent_key_
 
     # d) python objects
     if OriginType == None:
-        for var_name, type_hint in get_type_hints(Type).items():
-            if type_hint in type_map:
-                column_names.append(var_name + ' ' + type_map[type_hint])
-            else:
-                child_table_name = table_name + '$' + var_name
-                create_type_table(cursor, child_table_name, type_hint, parent_key_columns=[table_id + ' integer'])
+        plan = get_table_plan(table_name, Type)
+        for var_name in plan.scalar_columns:
+            column_names.append(var_name + ' ' + type_map[plan.type_hints[var_name]])
+        for var_name, typecode, view in plan.packed_fields:
+            column_names.append(var_name + ' blob')
+
+        for var_name, type_hint, child_table_name in plan.child_fields:
+            create_type_table(cursor, child_table_name, type_hint, parent_key_columns=[table_id + ' integer'])
 
         create_table(cursor, table_name, column_names)
         return
@@ -92,6 +271,7 @@ def get_next_index(cursor: sqlite3.Cursor, table_name: str, parent_keys: Dict[st
         return row[0] + 1
 
 
+@instrument.instrumented('sqlite.insert')
 def insert(cursor: sqlite3.Cursor, table_name: str, Type, obj: any, parent_keys: Dict[str, any]={}):
     table_id = f'{table_name}_id'
     values: Dict[str, any] = dict(parent_keys)
@@ -111,7 +291,7 @@ def insert(cursor: sqlite3.Cursor, table_name: str, Type, obj: any, parent_keys:
         index_key = 'index' + str(index_number)
         index_value = get_next_index(cursor, table_name, parent_keys, index_key)
         for item in obj:
-            item_parent_key_values = copy.deepcopy(parent_keys)
+            item_parent_key_values = dict(parent_keys)
             item_parent_key_values[index_key] = index_value
             insert(cursor, table_name, ItemType, item, item_parent_key_values)
             index_value += 1
@@ -124,29 +304,106 @@ def insert(cursor: sqlite3.Cursor, table_name: str, Type, obj: any, parent_keys:
         index_number = len(parent_keys)
         index_key = 'key' + str(index_number)
         for key, value in obj.items():
-            item_parent_key_values = copy.deepcopy(parent_keys)
+            item_parent_key_values = dict(parent_keys)
             item_parent_key_values[index_key] = key
             insert(cursor, table_name, ValueType, value, item_parent_key_values)
         return
 
     # d) python objects
     if OriginType is None:
-        for var_name, type_hint in get_type_hints(Type).items():
-            if type_hint in type_map:
-                values[var_name] = getattr(obj, var_name)
+        plan = get_table_plan(table_name, Type)
+        values.update(zip(plan.columns, plan.column_values(obj)))
 
-        insert_into_table(cursor, table_name, values)
+        cursor.execute(plan.insert_sql(tuple(values.keys())), list(values.values()))
         lastrowid = cursor.lastrowid
 
-        for var_name, type_hint in get_type_hints(Type).items():
-            if type_hint not in type_map:
-                child_table_name = table_name + '$' + var_name
-                insert(cursor, child_table_name, type_hint, getattr(obj, var_name), {table_id: lastrowid})
+        for var_name, type_hint, child_table_name in plan.child_fields:
+            insert(cursor, child_table_name, type_hint, getattr(obj, var_name), {table_id: lastrowid})
         return
 
     raise Exception(f'Error!  Unknown OriginType = {OriginType}')
     
 
+@instrument.instrumented('sqlite.insert_many')
+def insert_many(cursor: sqlite3.Cursor, table_name: str, Type, objs: Iterable, batch_size: int=1000) -> List[int]:
+    """Inserts `objs` of python object type `Type`, writing each table with one `executemany` per batch
+
+    Rows are flattened into per-table buffers, and object ids come from a range allocated
+    after the current maximum id of each table, instead of `lastrowid` per row.
+
+    Returns:
+        List[int]: The ids of the inserted top-level objects
+    """
+    next_ids: Dict[str, int] = {}
+    # (table_name, column_names) -> (insert SQL, rows)
+    table_rows: Dict[Tuple[str, Tuple[str, ...]], Tuple[str, List[tuple]]] = {}
+
+    def allocate_id(table_name: str) -> int:
+        if table_name not in next_ids:
+            table_id = f'{table_name}_id'
+            next_ids[table_name] = cursor.execute(f'select coalesce(max({table_id}), 0) + 1 from {table_name}').fetchone()[0]
+        id = next_ids[table_name]
+        next_ids[table_name] += 1
+        return id
+
+    def add_row(plan: TablePlan, column_names: Tuple[str, ...], values: tuple):
+        key = (plan.table_name, column_names)
+        if key not in table_rows:
+            table_rows[key] = (plan.insert_sql(column_names), [])
+        table_rows[key][1].append(values)
+
+    def flatten(table_name: str, Type, obj: any, parent_columns: Tuple[str, ...], parent_values: tuple) -> Optional[int]:
+        # a) simple datatypes (in type_map)
+        if Type in type_map:
+            add_row(get_table_plan(table_name, Type), parent_columns + ('value',), parent_values + (obj,))
+            return None
+
+        # b) Lists
+        OriginType = get_origin(Type)
+        if OriginType == list:
+            ItemType = get_args(Type)[0]
+            item_parent_columns = parent_columns + ('index' + str(len(parent_columns)),)
+            for index_value, item in enumerate(obj):
+                flatten(table_name, ItemType, item, item_parent_columns, parent_values + (index_value,))
+            return None
+
+        # c) Dicts
+        if OriginType == dict:
+            ValueType = get_args(Type)[1]
+            item_parent_columns = parent_columns + ('key' + str(len(parent_columns)),)
+            for key, value in obj.items():
+                flatten(table_name, ValueType, value, item_parent_columns, parent_values + (key,))
+            return None
+
+        # d) python objects
+        if OriginType is None:
+            plan = get_table_plan(table_name, Type)
+            id = allocate_id(table_name)
+
+            values = [id] + plan.column_values(obj)
+            add_row(plan, (plan.table_id, *plan.columns) + parent_columns, tuple(values) + parent_values)
+
+            for var_name, type_hint, child_table_name in plan.child_fields:
+                flatten(child_table_name, type_hint, getattr(obj, var_name), (plan.table_id,), (id,))
+            return id
+
+        raise Exception(f'Error!  Unknown OriginType = {OriginType}')
+
+    ids: List[int] = []
+    iterator = iter(objs)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if len(batch) == 0:
+            return ids
+
+        for obj in batch:
+            ids.append(flatten(table_name, Type, obj, (), ()))
+
+        for sql, rows in table_rows.values():
+            cursor.executemany(sql, rows)
+        table_rows.clear()
+
+
 def select_from_table(cursor: sqlite3.Cursor, table_name: str, column_names: List[str]=[], parent_keys: Dict[str, any]={}):
     column_names_string = ', '.join(column_names)
 
@@ -177,6 +434,7 @@ def select_key_values(cursor: sqlite3.Cursor, table_name: str, key_column_name:
     return return_list
 
 
+@instrument.instrumented('sqlite.get')
 def get(cursor: sqlite3.Cursor, table_name: str, Type, parent_keys: Dict[str, any]={}):
     table_id = f'{table_name}_id'
 
@@ -195,7 +453,7 @@ def get(cursor: sqlite3.Cursor, table_name: str, Type, parent_keys: Dict[str, an
 
         return_list: List = []
         for list_index in list_indices:
-            new_parent_keys = copy.deepcopy(parent_keys)
+            new_parent_keys = dict(parent_keys)
             new_parent_keys[key_column_name] = list_index
             item = get(cursor, table_name, ItemType, new_parent_keys)
             return_list.append(item)
@@ -211,7 +469,7 @@ def get(cursor: sqlite3.Cursor, table_name: str, Type, parent_keys: Dict[str, an
 
         return_dict = {}
         for dict_key in dict_keys:
-            new_parent_keys = copy.deepcopy(parent_keys)
+            new_parent_keys = dict(parent_keys)
             new_parent_keys[key_column_name] = dict_key
             item = get(cursor, table_name, ValueType, new_parent_keys)
             return_dict[dict_key] = item
@@ -220,49 +478,204 @@ def get(cursor: sqlite3.Cursor, table_name: str, Type, parent_keys: Dict[str, an
 
     # d) python objects
     if OriginType is None:
+        plan = get_table_plan(table_name, Type)
+        column_names = (table_id, *plan.columns)
 
-        column_names: List[str] = [table_id]
-        for var_name, type_hint in get_type_hints(Type).items():
-            if type_hint in type_map:
-                column_names.append(var_name)
-
-        kwargs = next(select_from_table(cursor, table_name, column_names, parent_keys))
-        table_id_value = kwargs[table_id]
-        del(kwargs[table_id])
+        row = cursor.execute(plan.select_sql(column_names, tuple(parent_keys.keys())), list(parent_keys.values())).fetchone()
+        kwargs = plan.column_kwargs(row[1:])
+        table_id_value = row[0]
 
-        for var_name, type_hint in get_type_hints(Type).items():
-            if type_hint not in type_map:
-                child_table_name = table_name + '$' + var_name
-                new_parent_keys = copy.deepcopy(parent_keys)
-                new_parent_keys[table_id] = table_id_value
-                child = get(cursor, child_table_name, type_hint, new_parent_keys)
-                kwargs[var_name] = child
+        # Each child table is read with one query, like in get_objects
+        for var_name, type_hint, child_table_name in plan.child_fields:
+            kwargs[var_name] = load_children(cursor, child_table_name, type_hint, table_id, [table_id_value])[table_id_value]
 
         return Type(**kwargs)
 
     raise Exception(f'Error!  Unknown OriginType = {OriginType}')
 
 
-def get_objects(cursor: sqlite3.Cursor, table_name: str, Type: Callable[[], T]) -> Iterable[T]:
-    table_id_column_name = f'{table_name}_id'
+def build_containers(items: Dict, levels: List[Tuple[type, str]]):
+    """Converts nested dicts keyed by each level's key column into the lists and dicts they represent"""
+    if len(levels) == 0:
+        return items
+
+    container_type = levels[0][0]
+    if container_type == list:
+        return [build_containers(item, levels[1:]) for item in items.values()]
+    else:
+        return {key: build_containers(item, levels[1:]) for key, item in items.items()}
 
-    column_names: List[str] = [table_id_column_name]
-    for var_name, type_hint in get_type_hints(Type).items():
-        if type_hint in type_map:
-            column_names.append(var_name)
 
-    for kwargs in select_from_table(cursor, table_name, column_names):
-        table_id_value = kwargs[table_id_column_name]
-        del(kwargs[table_id_column_name])
+def load_children(cursor: sqlite3.Cursor, table_name: str, Type, parent_key_column: str, parent_ids: List[int], batch_size: int=500) -> Dict[int, any]:
+    """Loads the values stored in the child table `table_name` for all of `parent_ids` at once
 
-        for var_name, type_hint in get_type_hints(Type).items():
-            if type_hint not in type_map:
-                child_table_name = table_name + '$' + var_name
-                new_parent_keys = {table_id_column_name: table_id_value}
-                child = get(cursor, child_table_name, type_hint, new_parent_keys)
-                kwargs[var_name] = child
+    Each child table is queried once per batch of parent ids, rather than once per element,
+    and the object graph is put together in memory.
+
+    Returns:
+        Dict[int, any]: The value for each parent id
+    """
+    plan = get_table_plan(table_name, Type)
+    levels = plan.levels
+    ItemType = plan.ItemType
 
-        yield Type(**kwargs)
+    if ItemType not in type_map and get_origin(ItemType) is not None:
+        raise Exception(f'Error!  Unknown OriginType = {get_origin(ItemType)}')
+
+    rows: List[tuple] = []
+    for start in range(0, len(parent_ids), batch_size):
+        batch_ids = parent_ids[start:start + batch_size]
+        rows.extend(cursor.execute(plan.children_sql(parent_key_column, len(batch_ids)), batch_ids))
+
+    value_start = 1 + len(levels)
+
+    # a) simple datatypes (in type_map)
+    if ItemType in type_map:
+        items = [row[value_start] for row in rows]
+
+    # d) python objects
+    else:
+        ids = [row[value_start] for row in rows]
+        children = {var_name: load_children(cursor, child_table_name, type_hint, plan.table_id, ids, batch_size) for var_name, type_hint, child_table_name in plan.child_fields}
+
+        items = []
+        for row in rows:
+            kwargs = plan.column_kwargs(row[value_start + 1:])
+            id = row[value_start]
+            for var_name in children:
+                kwargs[var_name] = children[var_name][id]
+            items.append(ItemType(**kwargs))
+
+    # Group the items by parent id, then by each level's key
+    grouped: Dict[int, any] = {}
+    for row, item in zip(rows, items):
+        parent_id = row[0]
+
+        if len(levels) == 0:
+            grouped.setdefault(parent_id, item)
+            continue
+
+        container = grouped.setdefault(parent_id, {})
+        for level_key in row[1:len(levels)]:
+            container = container.setdefault(level_key, {})
+        container[row[len(levels)]] = item
+
+    if len(levels) == 0:
+        missing_ids = [parent_id for parent_id in parent_ids if parent_id not in grouped]
+        if len(missing_ids) > 0:
+            raise Exception(f'Error!  No rows in {table_name} for {parent_key_column} in {missing_ids}')
+        return grouped
+
+    return {parent_id: build_containers(grouped.get(parent_id, {}), levels) for parent_id in parent_ids}
+
+
+class ChildLoader:
+    """Loads a child field of a batch of sibling objects, for all of them at once, when the first one is accessed"""
+
+    def __init__(self, cursor: sqlite3.Cursor, table_name: str, Type, parent_key_column: str, parent_ids: List[int], batch_size: int):
+        self.cursor = cursor
+        self.table_name = table_name
+        self.Type = Type
+        self.parent_key_column = parent_key_column
+        self.parent_ids = parent_ids
+        self.batch_size = batch_size
+        self.values: Optional[Dict[int, any]] = None
+
+    def get(self, parent_id: int) -> any:
+        if self.values is None:
+            self.values = load_children(self.cursor, self.table_name, self.Type, self.parent_key_column, self.parent_ids, self.batch_size)
+        # Each value is handed out once, to its proxy
+        return self.values.pop(parent_id)
+
+
+class LazyChild:
+    """Mixin for a UserList/UserDict whose `data` is loaded by a ChildLoader on first access"""
+
+    def __init__(self, initial: any=None, loader: Optional[ChildLoader]=None, parent_id: Optional[int]=None):
+        self._loader = loader
+        self._parent_id = parent_id
+        if loader is None:
+            super().__init__(initial)
+
+    @property
+    def data(self):
+        if self._loader is not None:
+            self._data = self._loader.get(self._parent_id)
+            self._loader = None
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self._loader = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._loader is None
+
+    # UserList/UserDict copy through __dict__['data'], which a property doesn't have
+    def __copy__(self) -> 'LazyChild':
+        return self.__class__(self.data)
+
+    def __reduce__(self):
+        return self.__class__, (self.data,)
+
+
+class LazyList(LazyChild, collections.UserList):
+    pass
+
+
+class LazyDict(LazyChild, collections.UserDict):
+    pass
+
+
+@instrument.instrumented('sqlite.get_objects')
+def get_objects(cursor: sqlite3.Cursor, table_name: str, Type: Callable[[], T], batch_size: int=500, lazy: bool=False, prefetch: List[str]=[]) -> Iterable[T]:
+    """Yields the objects stored in `table_name`, loading their child tables `batch_size` objects at a time
+
+    Args:
+        lazy (bool, optional): Return list and dict fields stored in child tables as LazyList/LazyDict
+            proxies, which query their child table on first access, for all the objects in the same
+            batch at once. Fields holding objects are always loaded. Defaults to False.
+        prefetch (List[str], optional): With `lazy`, names of the list and dict fields to load anyway
+    """
+    plan = get_table_plan(table_name, Type)
+    column_names = (plan.table_id, *plan.columns)
+
+    child_field_names = [var_name for var_name, type_hint, child_table_name in plan.child_fields]
+    unknown_fields = [var_name for var_name in prefetch if var_name not in child_field_names]
+    if len(unknown_fields) > 0:
+        raise Exception(f'Error!  {unknown_fields} are not fields of {Type} stored in child tables')
+
+    # (var_name, type_hint, child_table_name, proxy class) of the fields to load lazily
+    lazy_fields: List[Tuple[str, any, str, type]] = []
+    eager_fields: List[Tuple[str, any, str]] = []
+    for var_name, type_hint, child_table_name in plan.child_fields:
+        origin = get_origin(type_hint)
+        if lazy and var_name not in prefetch and origin in (list, dict):
+            lazy_fields.append((var_name, type_hint, child_table_name, LazyList if origin == list else LazyDict))
+        else:
+            eager_fields.append((var_name, type_hint, child_table_name))
+
+    rows = cursor.connection.execute(plan.select_sql(column_names))
+
+    while True:
+        batch = rows.fetchmany(batch_size)
+        if len(batch) == 0:
+            return
+
+        ids = [row[0] for row in batch]
+        children = {var_name: load_children(cursor, child_table_name, type_hint, plan.table_id, ids, batch_size) for var_name, type_hint, child_table_name in eager_fields}
+        loaders = {var_name: (ChildLoader(cursor, child_table_name, type_hint, plan.table_id, ids, batch_size), Proxy) for var_name, type_hint, child_table_name, Proxy in lazy_fields}
+
+        for row in batch:
+            kwargs = plan.column_kwargs(row[1:])
+            for var_name in children:
+                kwargs[var_name] = children[var_name][row[0]]
+            for var_name, (loader, Proxy) in loaders.items():
+                kwargs[var_name] = Proxy(loader=loader, parent_id=row[0])
+
+            yield Type(**kwargs)
 
 
 def main():
@@ -0,0 +1,31 @@
+from dataclasses import *
+from serialize import query
+from serialize.async_database import AsyncDatabase
+import asyncio
+import pytest
+
+
+@dataclass
+class Person:
+    name: str
+    age: int = None
+
+
+@pytest.mark.parametrize('pool_size', [0, 1])
+def test_group_commit(tmp_path, pool_size):
+    async def run():
+        db = AsyncDatabase(Person, str(tmp_path / 'data.db'), pool_size=pool_size)
+        ids = await asyncio.gather(*[db.insert(Person(f'n{i}', i)) for i in range(50)])
+        assert sorted(ids) == list(range(1, 51))
+        assert (await db.get(ids[7])).name == 'n7'
+
+        await db.create_index('age')
+        assert [person.name async for person in db.select(query.lt('age', 3), chunk_size=2)] == ['n0', 'n1', 'n2']
+
+        # close waits for inserts still being committed
+        pending = asyncio.ensure_future(db.insert_many([Person('late')]))
+        await asyncio.sleep(0)
+        await db.close()
+        assert (await pending) == [51]
+
+    asyncio.run(run())
@@ -0,0 +1,25 @@
+from typing import *
+from serialize import bench
+from serialize import json
+
+
+def test_peak_memory_excludes_setup():
+    benchmark = bench.Benchmark('setup', lambda: bytearray(10_000_000), lambda state, i: len(state[i:i + 10]), 5)
+    result = bench.run_benchmark(benchmark, repeat=1)
+    assert (result.operations, result.items) == (5, 50)
+    assert 0 < result.peak_memory < 1_000_000
+
+
+def test_main_smoke(tmp_path, capsys):
+    results_file = str(tmp_path / 'results.json')
+    assert bench.main(['--size', '10', '--repeat', '1', '--workload', 'flat', '--save', results_file]) == 0
+
+    with open(results_file) as fp:
+        results = json.load(fp, List[bench.BenchResult])
+    names = [result.name for result in results]
+    assert 'flat/json.dumps' in names and 'flat/database.select' in names and 'flat/sqlite.get_objects' in names
+    assert all(result.items > 0 and result.peak_memory > 0 for result in results)
+
+    # No throughput drop counts as a regression with a threshold of 100%
+    assert bench.main(['--size', '10', '--repeat', '1', '--workload', 'flat', '--filter', 'json', '--no-memory', '--baseline', results_file, '--threshold', '1']) == 0
+    assert 'flat/json.loads' in capsys.readouterr().out
@@ -0,0 +1,95 @@
+from dataclasses import *
+from typing import *
+from serialize import binary
+from serialize import query
+from serialize.database import Database
+import pytest
+import sqlite3
+
+
+@dataclass
+class Address:
+    town: str
+    number: int = None
+
+
+@dataclass
+class Person:
+    kind: ClassVar[str] = 'person'
+    name: str = None
+    score: float = None
+    address: Address = None
+    previous: List[Address] = field(default_factory=list)
+    counts: Dict[str, int] = field(default_factory=dict)
+    tags: Set[str] = field(default_factory=set)
+    parent: 'Person' = None
+
+
+@pytest.mark.parametrize('compression_level', [None, 6])
+def test_round_trip(compression_level):
+    codec = binary.codec_for(Person, compression_level)
+    person = Person('Ann', 1.5, Address('Leeds', 3), [Address('York')], {'a': 1}, {'x', 'y'}, Person('Bob'))
+    assert codec.loads(codec.dumps(person)) == person
+    assert codec.loads(codec.dumps(Person())) == Person()
+
+
+@pytest.mark.parametrize('storage', ['binary', 'binary-zlib'])
+def test_database_round_trip(tmp_path, storage):
+    filename = str(tmp_path / 'data.db')
+    db = Database(Person, filename, storage=storage)
+    ids = db.insert_many([Person('Ann', address=Address('Leeds')), Person('Bob')])
+    assert db.get(ids[0]).address.town == 'Leeds'
+    db.close()
+
+    db = Database(Person, filename)
+    assert db.storage == storage
+    assert [person.name for person in db.fetchall()] == ['Ann', 'Bob']
+    db.close()
+
+
+def test_refuses_other_marshal_format(tmp_path):
+    filename = str(tmp_path / 'data.db')
+    Database(Person, filename, storage='binary').close()
+
+    conn = sqlite3.connect(filename)
+    conn.execute("update serialize_metadata set value = 'marshal 0, Python 2.7' where key = 'binary_format'")
+    conn.commit()
+    conn.close()
+
+    with pytest.raises(Exception, match='marshal 0'):
+        Database(Person, filename)
+
+
+@dataclass
+class Doc:
+    name: str
+    metadata: List[str] = field(default_factory=list)
+    objects: List[str] = field(default_factory=list)
+
+
+@pytest.mark.parametrize('storage', ['json', 'binary'])
+def test_index_tables_dont_collide_with_internal_tables(tmp_path, storage):
+    db = Database(Doc, str(tmp_path / 'data.db'), storage=storage)
+    db.insert(Doc('a', ['x']))
+    db.create_index('metadata')
+    db.insert(Doc('b', ['y']))
+    assert [doc.name for doc in db.select(query.eq('metadata', 'y'))] == ['b']
+
+    with pytest.raises(Exception, match='internal objects table'):
+        db.create_index('objects')
+    db.insert(Doc('c'))
+    assert len(db.fetchall()) == 3
+    db.close()
+
+
+def test_renames_old_metadata_table(tmp_path):
+    filename = str(tmp_path / 'data.db')
+    Database(Person, filename, storage='binary').close()
+    conn = sqlite3.connect(filename)
+    conn.execute('alter table serialize_metadata rename to metadata')
+    conn.commit()
+    conn.close()
+
+    db = Database(Person, filename)
+    assert db.storage == 'binary'
+    db.close()
@@ -0,0 +1,402 @@
+from dataclasses import *
+from typing import *
+from serialize import database
+from serialize import json
+from serialize import query
+from serialize.cache import LRUCache
+from serialize.database import Database
+import concurrent.futures
+import pytest
+import sqlite3
+
+
+@dataclass
+class Person:
+    name: str
+    age: int = None
+    tags: List[str] = field(default_factory=list)
+
+
+@pytest.fixture
+def filename(tmp_path):
+    return str(tmp_path / 'data.db')
+
+
+def test_cache_skips_puts_after_invalidation():
+    cache = LRUCache(10)
+    generation = cache.generation
+    cache.invalidate([1])
+    cache.put(1, 'stale', generation)
+    assert cache.get(1) is None
+
+    cache.put(1, 'fresh', cache.generation)
+    assert cache.get(1) == 'fresh'
+
+
+@pytest.mark.parametrize('pool_size', [0, 2])
+def test_cache_invalidated_by_writes(filename, pool_size):
+    db = Database(Person, filename, cache_size=100, pool_size=pool_size)
+    ann, bob = db.insert_many([Person('Ann', 30), Person('Bob', 40)])
+    assert db.get(ann).age == 30
+
+    db.update(ann, Person('Ann', 31))
+    assert db.get(ann).age == 31
+
+    db.delete(query.eq('name', 'Bob'))
+    assert db.get(bob) is None
+
+    # The deleted object's id is reused
+    assert db.insert(Person('Cid', 50)) == bob
+    assert db.get(bob).name == 'Cid'
+    assert [person.name for person in db.select(order_by='name')] == ['Ann', 'Cid']
+
+    if pool_size > 0:
+        # A get while results are unfinished reads their snapshot, from before a concurrent update
+        results = db.select(batch_size=1)
+        next(results)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            executor.submit(db.update, ann, Person('Ann', 32)).result()
+        assert db.get(ann).age == 31
+        results.close()
+        assert db.get(ann).age == 32
+    db.close()
+
+
+def test_pool_readers_lent_per_read(filename):
+    db = Database(Person, filename, pool_size=2, pool_timeout=10)
+    people = [Person(f'n{i}', i) for i in range(100)]
+    db.insert_many(people)
+
+    # More threads than readers, each returning its reader once its read finishes
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda _: db.fetchall(), range(8)))
+    assert results == [people] * 8
+    assert db.reader_count <= 2
+
+    # Nested reads on a thread share its reader
+    assert [db.get(person.age + 1) for person in db.select(batch_size=10)] == people
+    db.close()
+
+
+def test_pool_timeout(filename):
+    db = Database(Person, filename, pool_size=1, pool_timeout=0.1)
+    db.insert_many([Person('Ann'), Person('Bob')])
+
+    results = db.select(batch_size=1)
+    next(results)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        with pytest.raises(Exception, match='reader connections'):
+            executor.submit(db.fetchall).result()
+
+        # Closing the unfinished results returns the reader
+        results.close()
+        assert executor.submit(db.fetchall).result() == [Person('Ann'), Person('Bob')]
+    db.close()
+
+
+def test_after_id_pages_in_id_order(filename):
+    db = Database(Person, filename)
+    db.insert_many([Person(f'n{i}', i % 4) for i in range(10)])
+    assert list(db.select_ids(after_id=7, order_by='id')) == [8, 9, 10]
+    assert list(db.select_ids(query.lt('age', 2), after_id=5, limit=2)) == [6, 9]
+
+    # Keyset pagination by id doesn't page through results in another order
+    with pytest.raises(Exception, match='after_id'):
+        list(db.select(after_id=5, order_by='-age'))
+    with pytest.raises(Exception, match='after_id'):
+        list(db.select_ids(after_id=5, order_by=['age', 'id']))
+    db.close()
+
+
+def test_predicates(filename):
+    db = Database(Person, filename)
+    people = [Person(f'n{i}', i % 10, ['a', 'b'][:i % 3]) for i in range(30)]
+    db.insert_many(people)
+    db.create_index('age')
+    db.create_index('tags')
+
+    def matching(predicate: query.Predicate) -> List[str]:
+        return [person.name for person in db.select(predicate)]
+
+    def names(condition: Callable[[Person], bool]) -> List[str]:
+        return [person.name for person in people if condition(person)]
+
+    assert matching(query.lt('age', 3) & query.eq('tags', 'b')) == names(lambda person: person.age < 3 and 'b' in person.tags)
+    assert matching(query.eq('age', 1) | query.in_('name', ['n2', 'n5'])) == names(lambda person: person.age == 1 or person.name in ['n2', 'n5'])
+    assert matching(~query.between('age', 2, 8) & query.like('name', 'n1%')) == names(lambda person: not 2 <= person.age <= 8 and person.name.startswith('n1'))
+    assert matching(query.sql('name', 'like "n2%"')) == names(lambda person: person.name.startswith('n2'))
+    assert list(db.select('name', 'like "n1%"')) == [person for person in people if person.name.startswith('n1')]
+
+    with pytest.raises(TypeError):
+        query.Predicate()
+    db.close()
+
+
+def test_insert_many(filename):
+    db = Database(Person, filename)
+    db.create_index('tags')
+    people = [Person(f'n{i}', i, ['a', 'b'][:i % 3]) for i in range(30)]
+    assert db.insert_many(people, batch_size=7) == list(range(1, 31))
+    assert db.insert_many([]) == []
+    assert db.insert(Person('last')) == 31
+    assert db.fetchall() == people + [Person('last')]
+
+    # Index rows are written with their batches
+    expected = sorted((id, tag) for id, person in enumerate(people, 1) for tag in person.tags)
+    assert sorted(db.conn.execute('select id, value from tags')) == expected
+
+    # A failing batch rolls back the whole insert
+    with pytest.raises(Exception):
+        db.insert_many([Person('ok'), Person('bad', tags=[object()])], batch_size=1)
+    assert len(db.fetchall()) == 31
+    db.close()
+
+
+@pytest.mark.parametrize('cache_size', [0, 10])
+def test_iterate_pages_and_raw(filename, cache_size):
+    db = Database(Person, filename, cache_size=cache_size)
+    people = [Person(f'n{i}', i) for i in range(25)]
+    db.insert_many(people)
+
+    results = db.iterate(batch_size=4)
+    assert next(results) == people[0]
+    assert list(results) == people[1:]
+
+    pages = []
+    after_id = None
+    while True:
+        page = list(db.iterate(after_id=after_id, limit=10, with_ids=True))
+        if len(page) == 0:
+            break
+        pages.append([id for id, person in page])
+        after_id = page[-1][0]
+    assert pages == [list(range(1, 11)), list(range(11, 21)), list(range(21, 26))]
+    assert list(db.iterate_ids(after_id=20, limit=3)) == [21, 22, 23]
+
+    assert list(db.iterate(limit=2, raw=True)) == [json.dumps(people[0]), json.dumps(people[1])]
+    assert list(db.select(query.eq('name', 'n3'), raw=True, with_ids=True)) == [(4, json.dumps(people[3]))]
+    db.close()
+
+
+def test_expression_index(filename):
+    db = Database(Person, filename)
+    people = [Person(f'n{i}', i % 10) for i in range(30)]
+    db.insert_many(people)
+    db.create_index('age')
+
+    # Scalar key paths are indexed on the JSON, without an index table
+    assert db.conn.execute("select expression from indexes where key_path = 'age'").fetchone() == ("json_extract(json, '$.age')",)
+    assert db.conn.execute("select name from sqlite_master where name = 'age'").fetchone() is None
+    conditions, parameters = db.where_sql(query.between('age', 2, 3))
+    plan = ' '.join(row[-1] for row in db.conn.execute('explain query plan select id from objects where ' + conditions[0], parameters))
+    assert 'age_index' in plan
+
+    # Maintained by SQLite through inserts, updates and deletes
+    db.insert(Person('new', 2))
+    db.update(1, Person('n0', 3))
+    db.delete(query.eq('name', 'n2'))
+    assert sorted(person.name for person in db.select(query.between('age', 2, 3))) == ['n0', 'n12', 'n13', 'n22', 'n23', 'n3', 'new']
+    db.close()
+
+
+def test_upgrade_database_without_expression_indexes(filename):
+    # The schema before metadata, expression indexes and resumable backfills
+    conn = sqlite3.connect(filename)
+    conn.execute('create table objects (id integer primary key, json text)')
+    conn.execute('create table indexes (table_name text, key_path text, unique(table_name), unique(key_path))')
+    conn.execute('create table tags (id integer, value text, foreign key(id) references objects(id) on delete cascade, unique(id, value))')
+    conn.executemany('insert into objects (json) values (?)', [(json.dumps(Person('Ann', 30, ['a'])),), (json.dumps(Person('Bob', 40, ['b'])),)])
+    conn.executemany('insert into tags (id, value) values (?, ?)', [(1, 'a'), (2, 'b')])
+    conn.execute("insert into indexes (table_name, key_path) values ('tags', 'tags')")
+    conn.commit()
+    conn.close()
+
+    db = Database(Person, filename)
+    assert db.storage == 'json'
+    assert [person.name for person in db.select(query.eq('tags', 'b'))] == ['Bob']
+
+    # Existing index tables keep working next to new expression indexes
+    db.create_index('age')
+    db.insert(Person('Cid', 50, ['b']))
+    assert [person.name for person in db.select(query.eq('tags', 'b') & query.gt('age', 45))] == ['Cid']
+    db.close()
+
+
+def test_update_diffs_index_rows(filename):
+    db = Database(Person, filename)
+    db.create_index('tags')
+    id = db.upsert('name', Person('Ann', 30, ['a', 'b']))
+    assert db.upsert('name', Person('Ann', 31, ['b', 'c'])) == id
+    assert db.fetchall() == [Person('Ann', 31, ['b', 'c'])]
+
+    # Only the changed entries are replaced
+    rowids = dict((value, rowid) for rowid, value in db.conn.execute('select rowid, value from tags'))
+    db.update(id, Person('Ann', 32, ['c', 'd']))
+    assert sorted(db.conn.execute('select value from tags where id = ?', (id,))) == [('c',), ('d',)]
+    assert db.conn.execute("select rowid from tags where value = 'c'").fetchone() == (rowids['c'],)
+    assert list(db.select(query.eq('tags', 'b'))) == []
+
+    db.insert(Person('Ann'))
+    with pytest.raises(Exception, match='2 objects'):
+        db.upsert('name', Person('Ann', 1))
+    with pytest.raises(Exception, match='No objects'):
+        db.update(100, Person('Bob'))
+    db.close()
+
+
+@pytest.mark.skipif(not hasattr(sqlite3, 'SQLITE_LIMIT_VARIABLE_NUMBER'), reason='Connection.setlimit needs Python 3.11')
+def test_update_many_within_variable_limit(filename):
+    db = Database(Person, filename)
+    db.create_index('tags')
+    ids = db.insert_many([Person(f'n{i}', i, ['a']) for i in range(1200)])
+
+    # SQLite's default limit before 3.32
+    db.conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+    db.update_many((id, Person(f'n{id}', id, ['b'])) for id in ids)
+    assert db.conn.execute("select count(*) from tags where value = 'b'").fetchone() == (1200,)
+    db.close()
+
+
+@pytest.mark.parametrize('storage', ['json', 'binary'])
+def test_projection(filename, storage):
+    db = Database(Person, filename, storage=storage)
+    people = [Person(f'n{i}', i, ['a', 'b'][:i % 3]) for i in range(5)]
+    db.insert_many(people)
+    expected = [{'name': person.name, 'tags': person.tags} for person in people]
+
+    if storage == 'json':
+        assert list(db.select(fields=['name', 'tags'])) == expected
+    else:
+        with pytest.raises(Exception, match='must be indexed'):
+            list(db.select(fields=['name']))
+
+    # Read from the indexes where they exist
+    db.create_index('name')
+    db.create_index('tags')
+    assert list(db.select(fields=['name', 'tags'])) == expected
+    assert list(db.select(query.eq('tags', 'b'), fields=['name'], with_ids=True)) == [(3, {'name': 'n2'})]
+    db.close()
+
+
+@pytest.mark.parametrize('parallel', [0, 2])
+def test_backfill_resumes_after_interruption(filename, monkeypatch, parallel):
+    db = Database(Person, filename, storage='binary')
+    people = [Person(f'n{i}', i, [f't{i % 4}']) for i in range(35)]
+    db.insert_many(people)
+
+    index_values = database.index_values
+    chunk_count = 0
+
+    def interrupt_second_chunk(*args):
+        nonlocal chunk_count
+        chunk_count += 1
+        if chunk_count == 2:
+            raise KeyboardInterrupt
+        return index_values(*args)
+
+    monkeypatch.setattr(database, 'index_values', interrupt_second_chunk)
+    with pytest.raises(KeyboardInterrupt):
+        db.create_index('tags', chunk_size=10)
+    monkeypatch.undo()
+
+    # The first chunk is committed, and the incomplete index isn't used
+    assert db.conn.execute("select backfilled_id from indexes where key_path = 'tags'").fetchone() == (10,)
+    assert db.conn.execute('select count(*) from tags').fetchone() == (10,)
+    with pytest.raises(Exception, match='must be indexed'):
+        list(db.select(query.eq('tags', 't1')))
+
+    # Writes during the build maintain the index
+    db.insert(Person('late', 99, ['t1']))
+
+    db.create_index('tags', chunk_size=10, parallel=parallel)
+    assert db.conn.execute("select backfilled_id from indexes where key_path = 'tags'").fetchone() == (None,)
+    assert [person.name for person in db.select(query.eq('tags', 't1'))] == [person.name for person in people if person.tags == ['t1']] + ['late']
+    assert db.conn.execute('select count(*) from tags').fetchone() == (36,)
+    db.close()
+
+
+def test_scan_parallel(filename):
+    db = Database(Person, filename)
+    people = [Person(f'n{i}', i % 10, ['a', 'b'][:i % 3]) for i in range(250)]
+    db.insert_many(people)
+    db.delete(query.eq('age', 3))
+
+    assert db.fetchall(parallel=2) == db.fetchall()
+    assert db.fetchall_with_ids(parallel=2) == db.fetchall_with_ids()
+    assert list(db.scan_parallel(2, chunk_size=17, with_ids=True)) == db.fetchall_with_ids()
+    assert sorted(db.scan_parallel(3, chunk_size=17, ordered=False, with_ids=True)) == db.fetchall_with_ids()
+
+    expected = list(db.select(query.lt('age', 5) & query.eq('tags', 'b'), with_ids=True))
+    assert list(db.scan_parallel(2, query.lt('age', 5) & query.eq('tags', 'b'), chunk_size=20, with_ids=True)) == expected
+    assert list(db.scan_parallel(2, 'name', 'like "n1%"', chunk_size=20)) == list(db.select('name', 'like "n1%"'))
+    db.close()
+
+    with pytest.raises(Exception, match='database file'):
+        list(Database(Person, ':memory:').scan_parallel(2))
+
+
+@dataclass
+class Visit:
+    town: str
+    days: int = None
+
+
+@dataclass
+class Traveller:
+    name: str
+    age: int = None
+    height: float = None
+    tags: List[str] = field(default_factory=list)
+    visits: List[Visit] = field(default_factory=list)
+
+
+@pytest.fixture
+def travellers(filename):
+    db = Database(Traveller, filename)
+    db.insert_many([Traveller(f'n{i}', i, 1.5 + i / 10, ['a', 'b'][:i % 3], [Visit('x', i), Visit('y')][:i % 3]) for i in range(10)])
+    yield db
+    db.close()
+
+
+def test_column_sql_branches(travellers):
+    statements = []
+    travellers.conn.set_trace_callback(statements.append)
+
+    def column(key_path: str, where: Optional[query.Predicate]=None) -> Tuple[List[int], List]:
+        statements.clear()
+        ids, values = travellers.column(key_path, where)
+        return list(ids), list(values)
+
+    # Extracted from the JSON, and fanned out over lists with json_each
+    assert column('height', query.gt('age', 6)) == ([8, 9, 10], [2.2, 2.3, 2.4])
+    assert 'json_extract' in statements[-1]
+    assert column('tags') == ([2, 3, 3, 5, 6, 6, 8, 9, 9], ['a', 'a', 'b', 'a', 'a', 'b', 'a', 'a', 'b'])
+    assert column('visits.days', query.lt('age', 5)) == ([2, 3, 5], [1, 2, 4])
+    assert 'json_each' in statements[-1]
+
+    # Read from an index table
+    travellers.create_index('tags')
+    assert column('tags', query.ge('age', 5)) == ([6, 6, 8, 9, 9], ['a', 'b', 'a', 'a', 'b'])
+    assert 'from tags' in statements[-1]
+
+    # Read from an expression index, or extracted with it when filtering
+    travellers.create_index('age')
+    ids, ages = travellers.column('age')
+    assert (ids.typecode, ages.typecode) == ('q', 'q')
+    assert (list(ids), list(ages)) == (list(range(1, 11)), list(range(10)))
+    assert column('age') == (list(range(1, 11)), list(range(10)))
+    assert 'indexed by age_index' in statements[-1]
+    assert column('age', query.eq('tags', 'b')) == ([3, 6, 9], [2, 5, 8])
+
+
+def test_column_as_numpy(travellers):
+    if database.numpy is None:
+        with pytest.raises(Exception, match='NumPy'):
+            travellers.column('age', as_numpy=True)
+
+    numpy = pytest.importorskip('numpy')
+    ids, heights = travellers.column('height', as_numpy=True)
+    assert ids.dtype == numpy.int64 and heights.dtype == numpy.float64
+    assert list(ids) == list(range(1, 11)) and list(heights) == [1.5 + i / 10 for i in range(10)]
+    ids, tags = travellers.column('tags', as_numpy=True)
+    assert tags.dtype == object and list(tags) == ['a', 'a', 'b', 'a', 'a', 'b', 'a', 'a', 'b']
@@ -0,0 +1,78 @@
+from dataclasses import *
+from typing import *
+from serialize import instrument
+from serialize import query
+from serialize import sqlite
+from serialize.database import Database
+import logging
+import sqlite3
+
+
+@dataclass
+class Person:
+    name: str
+    age: int = None
+
+
+def test_profile_records_operations(tmp_path):
+    db = Database(Person, str(tmp_path / 'data.db'), cache_size=100)
+    completed = []
+    with instrument.Profile(completed.append) as profile:
+        db.insert_many([Person(f'n{i}', i) for i in range(20)], batch_size=8)
+        db.insert(Person('last'))
+        assert len(list(db.select(query.lt('age', 5)))) == 5
+        db.get(1)
+    db.get(2)
+
+    operations = profile.operations
+    # Operations called by another operation are counted in the outermost one
+    assert sorted(operations) == ['Database.get', 'Database.insert', 'Database.insert_many', 'Database.select']
+    assert [stats.name for stats in completed] == ['Database.insert_many', 'Database.insert', 'Database.select', 'Database.get']
+    assert all(stats.calls == 1 for stats in operations.values())
+
+    insert_many = operations['Database.insert_many']
+    assert insert_many.rows >= 20
+    assert insert_many.sql['insert into objects (id, json) values (?, ?)'] == 3
+    assert insert_many.seconds >= insert_many.sqlite_seconds + insert_many.codec_seconds > 0
+
+    # Recorded until the results are exhausted, and the get is answered by the cache
+    assert (operations['Database.select'].cache_hits, operations['Database.select'].cache_misses) == (0, 5)
+    assert any('id in (?, ..., ?)' in sql for sql in operations['Database.select'].sql)
+    assert (operations['Database.get'].cache_hits, operations['Database.get'].statements) == (1, 0)
+
+    report = profile.report().splitlines()
+    assert report[0].split()[:3] == ['operation', 'calls', 'total']
+    assert {line.split()[0] for line in report[1:] if line.startswith('Database.')} == set(operations)
+    assert '3 x insert into objects (id, json) values (?, ?)' in [line.strip() for line in report]
+    db.close()
+
+
+def test_profile_records_sqlite_module(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'data.db'), factory=instrument.ProfiledConnection)
+    sqlite.create_type_table(conn.cursor(), 'people', Person)
+    with instrument.Profile() as profile:
+        # Cursors are profiled if created while a Profile is active
+        cursor = conn.cursor()
+        sqlite.insert_many(cursor, 'people', Person, [Person('Ann', 30), Person('Bob', 40)])
+        assert list(sqlite.get_objects(cursor, 'people', Person)) == [Person('Ann', 30), Person('Bob', 40)]
+
+    assert profile.operations['sqlite.insert_many'].statements > 0
+    assert profile.operations['sqlite.get_objects'].rows == 2
+    conn.close()
+
+
+def test_slow_query_warning(tmp_path, caplog):
+    db = Database(Person, str(tmp_path / 'data.db'), slow_query_seconds=0)
+    db.insert_many([Person('Ann', 30), Person('Bob', 40)])
+    with caplog.at_level(logging.WARNING):
+        assert len(list(db.select(query.eq('name', 'Bob')))) == 1
+    assert any(record.levelno == logging.WARNING and record.getMessage().startswith('Slow query') and "json_extract(json, '$.name') = ?" in record.getMessage()
+               for record in caplog.records)
+    db.close()
+
+    caplog.clear()
+    db = Database(Person, str(tmp_path / 'data.db'), slow_query_seconds=60)
+    with caplog.at_level(logging.WARNING):
+        list(db.select(query.eq('name', 'Bob')))
+    assert not any(record.getMessage().startswith('Slow query') for record in caplog.records)
+    db.close()
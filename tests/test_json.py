@@ -0,0 +1,135 @@
+from dataclasses import *
+from typing import *
+from serialize import json
+import fractions
+import io
+import os
+import pathlib
+import pytest
+import random
+import subprocess
+import sys
+import uuid
+
+
+@dataclass
+class Address:
+    town: str
+    number: int = None
+
+
+@dataclass
+class Person:
+    name: str
+    age: int = None
+    address: Address = None
+    tags: List[str] = field(default_factory=list)
+
+
+@dataclass
+class Team:
+    name: str
+    members: List[Person] = field(default_factory=list)
+    by_town: Dict[str, List[Address]] = field(default_factory=dict)
+    codes: Set[int] = field(default_factory=set)
+    scores: Dict[json.Interned, float] = field(default_factory=dict)
+    parent: 'Team' = None
+
+
+@dataclass
+class Pair:
+    pair: Tuple[int, int]
+
+
+def test_codec_round_trip():
+    team = Team('a', [Person('Ann', 45, Address('Leeds'), ['x'])], {'Leeds': [Address('Leeds', 1)]}, {1, 2}, {'high': 2.5}, Team('parent'))
+    text = json.dumps(team)
+    assert json.loads(text, Team) == team
+    assert json.loads(text, Dict[str, Any])['members'] == [{'name': 'Ann', 'age': 45, 'address': {'town': 'Leeds'}, 'tags': ['x']}]
+    assert json.loads(json.dumps([team, None]), List[Team]) == [team, None]
+    assert json.codec_for(Team) is json.codec_for(Team)
+
+    # None fields aren't stored, and ints decode to float fields
+    assert json.dumps(Address('York')) == '{"town": "York"}'
+    assert json.loads('{"name": "b", "scores": {"s": 1}}', Team).scores == {'s': 1.0}
+    assert type(json.loads('{"name": "b", "scores": {"s": 1}}', Team).scores['s']) is float
+
+
+@pytest.mark.parametrize('obj', [(1, 2), uuid.uuid4(), fractions.Fraction(1, 3), pathlib.PurePosixPath('/a'), Pair((1, 2))])
+def test_unserializable_types_raise(obj):
+    with pytest.raises(Exception, match='Cannot serialize'):
+        json.dumps(obj)
+
+
+@pytest.mark.parametrize('kind', json.compact_kinds)
+def test_compact_type_round_trip(kind):
+    CompactPerson = json.compact_type(Person, kind)
+    person = Person('Ann', 45, Address('Leeds', 3), ['a', 'b'])
+
+    compact = json.loads(json.dumps(person), CompactPerson)
+    assert (compact.name, compact.age, compact.address.town, compact.tags) == ('Ann', 45, 'Leeds', ['a', 'b'])
+    assert not hasattr(compact, '__dict__')
+    assert json.loads(json.dumps(compact), Person) == person
+
+
+@dataclass
+class Shape:
+    kind: ClassVar[str] = 'shape'
+    name: str
+    sides: int = None
+
+
+@pytest.mark.parametrize('kind', json.compact_kinds)
+def test_compact_type_skips_class_vars(kind):
+    CompactShape = json.compact_type(Shape, kind)
+    compact = CompactShape('square', 4)
+    assert json.dumps(compact) == json.dumps(Shape('square', 4)) == '{"name": "square", "sides": 4}'
+    assert json.loads(json.dumps(compact), Shape) == Shape('square', 4)
+    assert json.loads('{"name": "square"}', CompactShape).sides is None
+
+
+@pytest.mark.parametrize('buffer_size', range(1, 9))
+def test_stream_chunk_boundaries(buffer_size):
+    values = [0, -1, 2.5, 1e5, -3.25e-7, 123456789, 10.0, 'a"b', True, None, [1, 2.75], {'x': -0.5}]
+
+    stream = io.StringIO(json.dumps(values))
+    assert list(json.load_array_iter(stream, Any, buffer_size=buffer_size)) == values
+
+    lines = io.StringIO()
+    json.dump_iter(values, lines)
+    lines.seek(0)
+    assert list(json.load_iter(lines, Any, buffer_size=buffer_size)) == values
+
+    stream = io.BytesIO(json.dumps(['é', 'ü€']).encode())
+    assert list(json.load_array_iter(stream, str, buffer_size=buffer_size)) == ['é', 'ü€']
+
+
+def test_stream_many_floats():
+    random.seed(0)
+    values = [random.random() * 10 ** random.randint(-5, 5) for i in range(200000)]
+    assert list(json.load_array_iter(io.StringIO(json.dumps(values)), float)) == values
+
+    lines = io.StringIO()
+    json.dump_iter(values, lines)
+    lines.seek(0)
+    assert list(json.load_iter(lines, float)) == values
+
+
+def test_json_file_delayed_save_flushed_at_exit(tmp_path):
+    filename = str(tmp_path / 'data.json')
+    script = f'''
+from serialize import json
+json_file = json.JSONFile({filename!r}, dict, save_delay=60)
+json_file.contents['a'] = 1
+json_file.save()
+'''
+    subprocess.run([sys.executable, '-c', script], check=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert json.JSONFile(filename, dict).contents == {'a': 1}
+
+
+def test_json_file_background_save_errors_are_logged(tmp_path, caplog):
+    json_file = json.JSONFile(str(tmp_path / 'missing' / 'data.json'), dict, save_delay=0.2)
+    json_file.contents['a'] = 1
+    json_file.save()
+    json_file.timer.join()
+    assert 'Failed to save' in caplog.text
@@ -0,0 +1,72 @@
+from dataclasses import *
+from typing import *
+from serialize import query
+from serialize.database import Database
+from serialize.sharded_database import ShardedDatabase
+import pytest
+
+
+@dataclass
+class Person:
+    name: str
+    age: int = None
+    town: str = None
+
+
+@pytest.fixture
+def people():
+    return [Person(f'n{i}', i % 50, ['a', 'b', 'c'][i % 3]) for i in range(100)]
+
+
+@pytest.mark.parametrize('shard_key', [None, 'town'])
+def test_ids_map_to_objects(tmp_path, people, shard_key):
+    db = ShardedDatabase(Person, str(tmp_path / 'data.db'), shard_count=3, shard_key=shard_key)
+    ids = db.insert_many(people)
+    assert len(set(ids)) == len(people)
+
+    for id, person in zip(ids, people):
+        shard, local_id = db.local_id(id)
+        assert db.global_id(shard, local_id) == id
+        assert db.shards[shard].get(local_id) == person
+        assert db.get(id) == person
+
+    assert db.fetchall_with_ids() == sorted(zip(ids, people), key=lambda row: row[0])
+    db.close()
+
+
+def test_merged_select_matches_database(tmp_path, people):
+    db = ShardedDatabase(Person, str(tmp_path / 'data.db'), shard_count=3)
+    single = Database(Person, str(tmp_path / 'single.db'))
+    db.insert_many(people)
+    single.insert_many(people)
+
+    for kwargs in [dict(order_by=['-age', 'name']), dict(where=query.gt('age', 30), order_by='town', fields=['name']), dict(order_by='age', limit=7)]:
+        assert list(db.select(**kwargs)) == list(single.select(**kwargs))
+
+    first = list(db.select(with_ids=True, limit=10))
+    rest = list(db.select(with_ids=True, after_id=first[-1][0]))
+    assert [person for id, person in first + rest] == [person for id, person in db.select(with_ids=True)]
+    for database in (db, single):
+        with pytest.raises(Exception, match='after_id'):
+            list(database.select(after_id=first[-1][0], order_by='age'))
+
+    db.delete(query.eq('town', 'a'))
+    assert {person.town for person in db.fetchall()} == {'b', 'c'}
+    db.close()
+    single.close()
+
+
+def test_refuses_another_layout(tmp_path, people):
+    filename = str(tmp_path / 'data.db')
+    db = ShardedDatabase(Person, filename, shard_count=3)
+    db.insert_many(people)
+    db.close()
+
+    with pytest.raises(Exception, match='shard 0 of 3'):
+        ShardedDatabase(Person, filename, shard_count=2)
+    with pytest.raises(Exception, match='shard key'):
+        ShardedDatabase(Person, filename, shard_count=3, shard_key='town')
+
+    db = ShardedDatabase(Person, filename, shard_count=3)
+    assert len(db.fetchall()) == len(people)
+    db.close()
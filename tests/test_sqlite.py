@@ -0,0 +1,101 @@
+from dataclasses import *
+from typing import *
+from serialize import json
+from serialize import sqlite
+import copy
+import pickle
+import pytest
+import sqlite3
+
+
+@dataclass
+class Item:
+    name: str
+    count: int
+
+
+@dataclass
+class Order:
+    number: int = None
+    notes: List[str] = field(default_factory=list)
+    prices: Dict[str, float] = field(default_factory=dict)
+    items: List[Item] = field(default_factory=list)
+    by_name: Dict[str, Item] = field(default_factory=dict)
+
+
+@pytest.fixture
+def cursor():
+    conn = sqlite3.connect(':memory:')
+    cursor = conn.cursor()
+    sqlite.create_type_table(cursor, 'orders', Order)
+    yield cursor
+    conn.close()
+
+
+@pytest.fixture
+def orders():
+    return [Order(i, [f'note {j}' for j in range(i % 3)], {'a': i / 2}, [Item('x', i), Item('y', 2)], {'z': Item('z', i)}) for i in range(1, 6)]
+
+
+def test_get_objects_round_trip(cursor, orders):
+    sqlite.insert_many(cursor, 'orders', Order, orders)
+    assert list(sqlite.get_objects(cursor, 'orders', Order, batch_size=2)) == orders
+
+
+def test_get(cursor, orders):
+    for order in orders:
+        sqlite.insert(cursor, 'orders', Order, order)
+    assert sqlite.get(cursor, 'orders', Order, {'orders_id': 3}) == orders[2]
+
+    @dataclass
+    class Basket:
+        label: str = 'basket'
+        orders: List[Order] = field(default_factory=list)
+
+    sqlite.create_type_table(cursor, 'baskets', Basket)
+    sqlite.insert_many(cursor, 'baskets', Basket, [Basket('first', orders[:2]), Basket('second', orders[2:])])
+    assert sqlite.get(cursor, 'baskets', Basket, {'baskets_id': 2}) == Basket('second', orders[2:])
+
+
+def test_lazy_children_behave_like_containers(cursor, orders):
+    sqlite.insert_many(cursor, 'orders', Order, orders)
+    lazy_orders = list(sqlite.get_objects(cursor, 'orders', Order, lazy=True))
+    assert not lazy_orders[0].notes.loaded
+
+    assert json.loads(json.dumps(lazy_orders), List[Order]) == orders
+
+    notes = copy.copy(lazy_orders[1].notes)
+    notes.append('new')
+    assert lazy_orders[1].notes == orders[1].notes
+    assert copy.deepcopy(lazy_orders[2]) == orders[2]
+    assert pickle.loads(pickle.dumps(lazy_orders[3].prices)) == orders[3].prices
+
+
+@dataclass
+class Series:
+    label: str
+    samples: List[float] = sqlite.packed_field(default_factory=list)
+    counts: List[int] = sqlite.packed_field(view=True, default_factory=list)
+
+
+def test_packed_fields_round_trip(cursor):
+    sqlite.create_type_table(cursor, 'series', Series)
+    series = [Series('a', [0.5, -1.25, 1e300], [1, -2, 2**62]), Series('empty'), Series('b', [3.0], [7])]
+    sqlite.insert(cursor, 'series', Series, series[0])
+    sqlite.insert_many(cursor, 'series', Series, series[1:])
+
+    # Stored in BLOB columns, not child tables
+    assert [row[0] for row in cursor.execute("select name from sqlite_master where type = 'table' and name like 'series%'")] == ['series']
+
+    def as_lists(loaded: Series) -> Series:
+        assert type(loaded.counts) is memoryview and loaded.counts.readonly
+        return replace(loaded, counts=loaded.counts.tolist())
+
+    assert [as_lists(loaded) for loaded in sqlite.get_objects(cursor, 'series', Series)] == series
+    assert as_lists(sqlite.get(cursor, 'series', Series, {'series_id': 2})) == Series('empty')
+
+    # Views compare unequal to lists, and aren't serializable
+    loaded = sqlite.get(cursor, 'series', Series, {'series_id': 3})
+    assert loaded != series[2]
+    with pytest.raises(Exception, match='Cannot serialize'):
+        json.dumps(loaded)